@@ -1,33 +1,386 @@
+import os
+import stat
+import time
+import signal
 import socket
+import asyncio
 import argparse
 import logging
 from pathlib import Path
 import requests
-from utils.packet_utils import ClientProtocol
+from utils.packet_utils import ClientProtocol, FRAME_HEADER, FRAME_DATA, FRAME_ERROR, FLAG_CRC32, FLAG_ZLIB, CHECKSUM, MAX_FRAME_PAYLOAD, PEER_LIST, PEER_PORT, PEER_ADDR_SIZE, parse_frame_header, peer_name, verify_checksum
 from utils.byte_utils import *
+from utils.file_utils import preallocate, write_at
+from utils.socket_utils import recv_exact, recv_into_exact, is_dropped
+from utils.scheduler import ChunkScheduler, split_range
+from utils.peer_stats import PeerStats
+from utils.http_utils import make_session
+from utils.manifest import Manifest
+from utils.digest import FileDigest
+from utils.job_api import send_message, recv_message, request, parse_batch_line, DAEMON_SOCKET
+from utils.peer_subscription import PeerSubscription
+from utils.async_engine import AsyncEngine
+from utils.peer_session import PeerSession
+from utils.compression import CODECS, decompress_frame
+from utils.mirrors import MirrorSet
+from utils.metrics import Metrics, TraceLog, serve_metrics
 import threading
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of the blocks the local downloader reads from the origin
+BLOCK_SIZE = 64 * 1024
+
+# Name of the local downloader in peer statistics
+LOCAL = "local"
+
+# Minimum seconds between manifest checkpoints
+MANIFEST_INTERVAL = 1.0
+
+# Files up to this size are one chunk, fetched by whichever participant is free
+SMALL_FILE = 1024 * 1024
+
+# Finished jobs the daemon keeps around for status requests
+JOB_HISTORY = 1000
+
+class DownloadJob:
+    # One file to download: its output, resume manifest and chunk plan
+    def __init__(self, url, path, sha256 = None, job_id = None, mirrors = None):
+        self.id = job_id
+        self.url = url
+        self.mirrors = MirrorSet([url] + list(mirrors or []))
+        self.path = Path(path)
+        self.manifest_path = self.path.with_name(self.path.name + ".manifest")
+        self.sha256 = sha256.lower() if sha256 else None
+        self.checkpoint_lock = threading.Lock()
+        self.close_lock = threading.Lock()
+        self.state = "queued"
+        self.error = None
+        self.file_size = None
+        self.done_bytes = 0
+        self.fd = None
+
+        # Writers in progress, the job is only closed once they are out
+        self.writers = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def get_download_info(self, session):
+
+        # Find file size & partial download support
+        self.file_size, etag, last_modified = self.head(session, self.url)
+
+        # Identifies this version of the remote file
+        self.validator = {
+            'size': self.file_size,
+            'etag': etag,
+            'last_modified': last_modified
+        }
+
+        # Sent along with range requests so peers can cache chunks of this version
+        tag = self.validator['etag'] or self.validator['last_modified']
+        self.cache_validator = f"{self.file_size}/{tag}" if tag else ""
+
+        logging.info(f"File size of {self.url} -> {self.file_size} bytes")
+
+        # Mirrors must serve the same version of the file
+        for mirror in self.mirrors.urls[1:]:
+            try:
+                size, etag, last_modified = self.head(session, mirror)
+            except (requests.RequestException, KeyError, ValueError) as e:
+                logging.error(f"Dropping mirror {mirror}: {e}")
+                self.mirrors.drop(mirror)
+                continue
+
+            if (
+                size != self.file_size or \
+                (etag and self.validator['etag'] and etag != self.validator['etag']) or \
+                (last_modified and self.validator['last_modified'] and last_modified != self.validator['last_modified'])
+            ):
+                logging.error(f"Dropping mirror {mirror}: it does not match {self.url}!")
+                self.mirrors.drop(mirror)
+
+        if len(self.mirrors) > 1:
+            logging.info(f"Mirrors of {self.url} -> {self.mirrors.urls}")
+
+    def head(self, session, url):
+        # Returns (size, ETag, Last-Modified) of a URL that accepts ranges
+        r = session.head(url)
+        r.raise_for_status()
+        headers = r.headers
+
+        if headers.get('Accept-Ranges') != "bytes":
+            raise ValueError(f"{url} does not accept ranges!")
+
+        return (int(headers['Content-Length']), headers.get('ETag'), headers.get('Last-Modified'))
+
+    def split_download(self, chunk_size, participants, weights):
+
+        if chunk_size or self.file_size <= SMALL_FILE:
+            # Many fixed size chunks, pulled by whichever participant is free
+            self.download_ranges = split_range(0, self.file_size - 1, chunk_size or SMALL_FILE)
+            self.download_owners = None
+            logging.info(f"Download split into {len(self.download_ranges)} chunks of {chunk_size or SMALL_FILE} bytes")
+            return
+
+        # One range per participant, sized by its expected bandwidth
+        total = sum(weights)
+
+        self.download_ranges = []
+        self.download_owners = []
+
+        start = 0
+        for i, participant in enumerate(participants):
+            if i == len(participants) - 1:
+                end = self.file_size - 1
+            else:
+                end = start + int(self.file_size * weights[i] / total) - 1
+
+            if end >= start:
+                self.download_ranges.append((start, end))
+                self.download_owners.append(participant)
+                start = end + 1
+
+        logging.info(f"Download ranges -> {list(zip(self.download_owners, self.download_ranges))}")
+
+    def load_manifest(self):
+
+        # Resume from a previous run only if the remote file is unchanged and the output is still there
+        manifest = Manifest.load(self.manifest_path)
+        if (
+            manifest and \
+            manifest.matches(self.url, self.validator) and \
+            self.path.exists() and \
+            self.path.stat().st_size == self.file_size
+        ):
+            self.manifest = manifest
+            self.download_ranges = manifest.ranges
+            self.download_owners = None
+            logging.info(f"Resuming {self.path}, {len(manifest.missing())} of {len(manifest.ranges)} chunks missing")
+            return
+
+        if manifest:
+            logging.info(f"Remote file of {self.path} changed, discarding manifest!")
+            manifest.remove()
+
+        self.manifest = Manifest(self.manifest_path, self.url, self.validator, self.download_ranges)
+
+    def open(self):
+
+        # Ranges are written in place, so the output file is created at its final size
+        self.fd = preallocate(self.path, self.file_size)
+        self.last_checkpoint = 0
+        self.checkpoint(force = True)
+
+        # Chunks the job is still waiting on, done or given up
+        self.pending = set(self.manifest.missing())
+        self.done_bytes = sum(end - start + 1 for i, (start, end) in enumerate(self.download_ranges) if i not in self.pending)
+        self.state = "downloading"
+
+        # Whole file digest is computed as chunks land, chunks from a previous run are read back once
+        self.digest = FileDigest(self.fd, self.file_size) if self.sha256 else None
+        if self.digest:
+            for i, download_range in enumerate(self.download_ranges):
+                if self.manifest.is_done(i):
+                    self.digest.add_existing(*download_range)
+
+    def chunks(self):
+        # Returns the missing chunks as ((job, index), range) and their owners
+        missing = self.manifest.missing()
+        chunks = [((self, i), self.download_ranges[i]) for i in missing]
+        owners = [self.download_owners[i] if self.download_owners else None for i in missing]
+        return chunks, owners
+
+    def land(self, offset, data):
+        # Write verified data at its offset and feed it to the whole file digest
+        with self.cond:
+            if self.closed:
+                # Late data from a losing hedge
+                return
+            self.writers += 1
+
+        try:
+            write_at(self.fd, data, offset)
+            if self.digest:
+                self.digest.update(offset, data)
+        finally:
+            with self.cond:
+                self.writers -= 1
+                self.cond.notify_all()
+
+    def complete(self, i):
+        # Returns True once this was the last chunk the job was waiting on
+        with self.cond:
+            if i not in self.pending:
+                return False
+
+            self.pending.discard(i)
+            self.manifest.mark(i)
+            self.done_bytes += self.download_ranges[i][1] - self.download_ranges[i][0] + 1
+            last = not self.pending
+
+        self.checkpoint()
+        return last
+
+    def give_up(self, i):
+        # Returns True once this was the last chunk the job was waiting on
+        with self.cond:
+            if i not in self.pending:
+                return False
+
+            self.pending.discard(i)
+            return not self.pending
+
+    def keys(self):
+        return [(self, i) for i in range(len(self.download_ranges))]
+
+    def status(self):
+        return {
+            'id': self.id,
+            'url': self.url,
+            'mirrors': self.mirrors.urls[1:],
+            'path': str(self.path),
+            'state': self.state,
+            'size': self.file_size,
+            'done_bytes': self.done_bytes,
+            'error': self.error
+        }
+
+    def checkpoint(self, force = False):
+
+        # Flush the output before the manifest records chunks as done
+        with self.checkpoint_lock:
+            if self.fd is None:
+                return
+
+            now = time.monotonic()
+            if not force and now - self.last_checkpoint < MANIFEST_INTERVAL:
+                return
+
+            self.last_checkpoint = now
+            os.fdatasync(self.fd)
+            self.manifest.save()
+
+    def close(self):
+        # Returns True if the file is complete and matches its expected digest.
+        # Closing again waits for the first close and returns its result.
+        with self.close_lock:
+            with self.cond:
+                if self.closed and self.fd is None:
+                    return self.state == "complete"
+                self.closed = True
+                self.cond.wait_for(lambda: not self.writers)
+
+            self.checkpoint(force = True)
+
+            missing = self.manifest.missing()
+            digest = self.digest.hexdigest() if self.digest and not missing else None
+
+            with self.checkpoint_lock:
+                os.close(self.fd)
+                self.fd = None
+
+            if missing:
+                self.fail(f"{len(missing)} ranges incomplete! Run again to resume.")
+                return False
+
+            self.manifest.remove()
+
+            if digest and digest != self.sha256:
+                self.fail(f"SHA-256 mismatch! Expected {self.sha256}, got {digest}")
+                return False
+
+            self.state = "complete"
+            logging.info(f"Downloaded {self.url} -> {self.path}")
+            return True
+
+    def fail(self, error):
+        self.state = "failed"
+        self.error = error
+        logging.error(f"{self.path}: {error}")
 
 class Client:
-    def __init__(self, tracker_ip, tracker_port, path, url, client_server_port, client_tracker_port, server_port):
+    def __init__(self, tracker_ip, tracker_port, path, url, client_server_port, client_tracker_port, server_port, chunk_size = 4 * 1024 * 1024, stats_path = ".peer_stats", pipeline_depth = 2, http_pool_size = 16, progress_timeout = 30, max_retries = 3, hedge_delay = 5, sha256 = None, batch = None, peer_list_max_age = 30, peer_count = 0, peer_selection = "load", engine = "threads", max_inflight = 256, compression = "none", mirrors = None, metrics_port = 0, trace_path = None):
         self.tracker_ip = tracker_ip
         self.tracker_port = int(tracker_port)
-        self.path = Path(path)
+        self.path = path
         self.url = url
+        self.mirrors = mirrors or []
+        self.batch = batch
         self.client_server_port = int(client_server_port)
         self.client_tracker_port = int(client_tracker_port)
         self.server_port = int(server_port)
+        self.chunk_size = int(chunk_size)
+        self.peer_stats = PeerStats(stats_path)
+        self.pipeline_depth = int(pipeline_depth)
+        self.http_pool_size = int(http_pool_size)
+        self.session = make_session(http_pool_size)
+        self.progress_timeout = float(progress_timeout)
+        self.max_retries = int(max_retries)
+        self.hedge_delay = float(hedge_delay)
+        self.sha256 = sha256
+        self.peer_list_max_age = float(peer_list_max_age)
+        self.peer_count = int(peer_count)
+        self.peer_selection = peer_selection
+        self.engine = engine
+        self.max_inflight = int(max_inflight)
+        self.compression = compression if compression in CODECS else None
+        self.peer_socks = set()
+        self.peer_socks_lock = threading.Lock()
+        self.peer_stops = {}
+        self.peer_addrs = {}
+        self.plain_peers = set()
+        self.peer_servers = []
+        self.jobs = []
+        self.submitted = OrderedDict()
+        self.submitted_lock = threading.Lock()
+
+        self.metrics_port = int(metrics_port)
+        self.trace = TraceLog(trace_path) if trace_path else None
+        self.define_metrics()
+
+    def define_metrics(self):
+        m = self.metrics = Metrics("peer_client")
+        m.gauge("peers", "Peer servers in use", collect = lambda: len(self.peer_servers))
+        m.gauge("jobs", "Files by state", collect = self.job_states, label = "state")
+        m.gauge("peer_throughput_bytes_per_second", "Smoothed throughput of each peer server and the origin", collect = self.peer_stats.stats, label = "peer")
+        m.histogram("queue_wait_seconds", "Time chunks waited in the queue for a worker")
+        m.histogram("chunk_seconds", "Time from requesting a range to its last byte")
+        m.counter("bytes_total", "Bytes received by source")
+        m.counter("ranges_total", "Ranges by result")
+
+    def job_states(self):
+        # Jobs of the daemon, or of a one-shot or batch run
+        with self.submitted_lock:
+            jobs = list(self.submitted.values()) or self.jobs
+
+        states = {}
+        for job in jobs:
+            states[job.state] = states.get(job.state, 0) + 1
+        return states
+
+    def trace_chunk(self, event, chunk, **fields):
+        if self.trace:
+            job, i = chunk
+            self.trace.write(event, job = job.id, chunk = i, **fields)
 
     def run(self):
+        if self.metrics_port:
+            serve_metrics(self.metrics, self.metrics_port)
+
+        if self.engine == "asyncio":
+            # Same steps, with peer transfers on one event loop
+            asyncio.run(AsyncEngine(self).run())
+            return
+
         # Get peer servers
         self.get_peer_servers()
 
-        # Get download info
-        self.get_download_info()
+        # Get download info, ranges and resume state of every file
+        self.prepare_jobs()
 
-        # Get download ranges
-        self.split_download()
-
-        # Download and merge
+        # Download into output files
         self.download()
     
     def get_peer_servers(self):
@@ -35,6 +388,7 @@ class Client:
 
         # Connect to tracker
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind(('', self.client_server_port))
         sock.connect((self.tracker_ip, self.tracker_port))
 
@@ -52,10 +406,29 @@ class Client:
         else:
             logging.info("Validated handshake!")
 
-        # Get peer servers
-        fetch_peer_servers = client_proto.gen_fetcher()
-        sock.send(fetch_peer_servers.encode())
-        self.peer_servers = client_proto.parse_ips(sock.recv(1024))
+        # Get peer servers, only peer_count of them picked by the tracker if set, otherwise page through all of them
+        if self.peer_count:
+            peers = self.query_peers(sock, client_proto, self.peer_selection, 0, self.peer_count)[1]
+        else:
+            peers = []
+            while True:
+                total, page = self.query_peers(sock, client_proto, "page", len(peers))
+                peers += page
+                if not page or len(peers) >= total:
+                    break
+
+        self.set_peer_servers(peers)
+
+        # Wait for the tracker to close first, so a restart can rebind our fixed port right away
+        sock.shutdown(socket.SHUT_WR)
+        sock.recv(1024)
+        sock.close()
+
+    def set_peer_servers(self, peers):
+        # peers is a list of (IP, port) from the tracker, each is known by its name from then on
+        for addr in peers:
+            self.peer_addrs[peer_name(*addr)] = addr
+        self.peer_servers = list(dict.fromkeys(peer_name(*addr) for addr in peers))
 
         if self.peer_servers == []:
             logging.error("No peer servers found! Exiting!")
@@ -63,116 +436,526 @@ class Client:
 
         logging.info(f"Peer servers: {self.peer_servers}")
 
-        sock.shutdown(socket.SHUT_RDWR)
-        sock.close()
+    def query_peers(self, sock, client_proto, mode, offset = 0, count = 0):
+        # Returns (peers known to the tracker, [(IP, port)]) of one peer query, read in full whatever its size
+        sock.sendall(client_proto.gen_query(mode, offset, count))
 
-    def get_download_info(self):
+        out = client_proto.parse_peer_list(recv_exact(sock, PEER_LIST.size))
+        if not out:
+            raise ConnectionError("Invalid peer list!")
 
-        # Find file size & partial download support  
-        r = requests.head(self.url)
-        headers = r.headers
-        self.file_size = int(headers['Content-Length'])
+        total, count = out
+        peers = []
+        for _ in range(count):
+            family = recv_exact(sock, 1)
+            peer = family and client_proto.parse_peer(family + recv_exact(sock, PEER_ADDR_SIZE.get(family[0], 0) + PEER_PORT.size))
+            if not peer:
+                raise ConnectionError("Invalid peer list!")
+            peers.append(peer)
 
-        if headers['Accept-Ranges'] != "bytes":
-            logging.error("This URL does not accept ranges!")
-            exit(1)
-        
-        logging.info(f"File size -> {self.file_size} bytes")
-    
-    def split_download(self):
+        return (total, peers)
 
-        # Calculate download ranges
-        logging.info(f"Downloading with peer servers {self.peer_servers}")
-        server_count = len(self.peer_servers) + 1
+    def load_jobs(self):
+        if not self.batch:
+            return [DownloadJob(self.url, self.path, self.sha256, 1, self.mirrors)]
 
-        parts = self.file_size // server_count 
+        jobs = []
+        with open(self.batch, "r") as f:
+            for line in f.readlines():
+                fields = parse_batch_line(line)
+                if fields:
+                    jobs.append(DownloadJob(fields['url'], fields['path'], fields['sha256'], len(jobs) + 1, fields['mirrors']))
 
-        self.download_ranges = []
+        paths = [job.path for job in jobs]
+        if len(set(paths)) != len(paths):
+            raise ValueError("Batch file has duplicate output paths!")
 
-        for i in range(server_count - 1):
-            self.download_ranges.append((parts * i, parts * (i + 1) - 1))
-        
-        self.download_ranges.append((parts * (server_count - 1), self.file_size - 1))
+        return jobs
 
-        logging.info(f"Download ranges -> {self.download_ranges}")
-    
-    def download(self):
+    def prepare_job(self, job):
+        try:
+            job.get_download_info(self.session)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            job.fail(f"Skipping {job.url}: {e}")
+            return False
+
+        # One range per participant is sized by its expected bandwidth
+        participants = self.peer_servers + [LOCAL]
+        job.split_download(self.chunk_size, participants, self.peer_stats.weights(participants))
+        job.load_manifest()
+        return True
+
+    def prepare_jobs(self):
+        self.jobs = self.load_jobs()
+        logging.info(f"Downloading {len(self.jobs)} files with peer servers {self.peer_servers}")
+
+        # HEAD requests overlap on the pooled session
+        with ThreadPoolExecutor(max_workers = max(1, min(len(self.jobs), self.http_pool_size))) as pool:
+            prepared = list(pool.map(self.prepare_job, self.jobs))
+
+        if not any(prepared):
+            logging.error("Nothing to download! Exiting!")
+            exit(1)
+
+    def start_job(self, scheduler, job):
+        try:
+            job.open()
+        except OSError as e:
+            job.fail(f"Could not open output: {e}")
+            return
+
+        chunks, owners = job.chunks()
+        if self.trace:
+            self.trace.write("job", job = job.id, url = job.url, path = str(job.path), size = job.file_size, chunks = len(chunks))
+
+        if chunks:
+            scheduler.add(chunks, owners)
+        else:
+            self.close_job(scheduler, job)
 
+    def close_job(self, scheduler, job):
+        # Runs on whichever worker settled the last chunk of the job
+        job.close()
+        scheduler.forget(job.keys())
+        self.peer_stats.save()
+
+    def start_workers(self, scheduler, daemon = False):
         threads = []
-        results = [None] * len(self.download_ranges)
 
-        # Multithreaded downloader
-        for i in range(len(self.download_ranges) - 1):
-            # Peer server downloads
-            thread = threading.Thread(target = self.server_downloader, args=(self.download_ranges[i], results, i))
-            threads.append(thread)
-            thread.start()
+        # Multithreaded downloader, one worker per peer server
+        for peer in self.peer_servers:
+            threads.append(self.start_peer_worker(scheduler, peer, daemon))
 
         # Peer client download
-        thread = threading.Thread(target = self.client_downloader, args=(self.download_ranges[-1], results, len(self.download_ranges) - 1))
+        thread = threading.Thread(target = self.client_worker, args=(scheduler,), daemon = daemon)
         threads.append(thread)
         thread.start()
 
+        return threads
+
+    def start_peer_worker(self, scheduler, peer, daemon = False):
+        # A stopped worker finishes what it has in flight, a peer that comes back gets a new one
+        if peer in self.peer_stops:
+            self.peer_stops[peer].set()
+
+        stop = self.peer_stops[peer] = threading.Event()
+        thread = threading.Thread(target = self.server_worker, args=(peer, scheduler, stop), daemon = daemon)
+        thread.start()
+        return thread
+    
+    def download(self):
+
+        # One scheduler for the chunks of every file, so idle peers pick up whatever is left anywhere
+        scheduler = self.new_scheduler()
+        for job in self.jobs:
+            if job.state == "queued":
+                self.start_job(scheduler, job)
+
+        threads = self.start_workers(scheduler)
+
+        # Once every chunk is settled, cut off peers still busy with a losing hedge
+        while any(thread.is_alive() for thread in threads):
+            if scheduler.wait_finished(0.5):
+                break
+
+        self.close_peer_connections()
+
         for i, thread in enumerate(threads):
             thread.join()
-        
-        self.merge_and_save(results)
-    
-    def client_downloader(self, range, results, i):
-        logging.info(f"Downloading locally for range {range}")
 
-        # Download locally
-        r = requests.get(self.url, headers = {"Range" : f"bytes={range[0]}-{range[1]}"})
-        results[i] = r.content
+        self.finish_download()
 
-        logging.info(f"Range {range} done! -> {len(results[i])} bytes")
-    
-    def server_downloader(self, range, results, i):
-        logging.info(f"Downloading for range {range}")
+    def new_scheduler(self, keep_open = False):
+        scheduler = ChunkScheduler([], None, self.max_retries, self.hedge_delay, keep_open)
+        scheduler.watch_takes(self.chunk_taken)
+        return scheduler
+
+    def chunk_taken(self, chunk, worker, waited):
+        key, download_range = chunk
+        if waited is not None:
+            self.metrics.observe("queue_wait_seconds", waited)
+        self.trace_chunk("take" if waited is not None else "hedge", key, peer = worker, range = list(download_range), wait = waited)
+
+    def finish_download(self):
+        self.peer_stats.save()
+
+        # Jobs still open ran out of workers before all their chunks settled
+        for job in self.jobs:
+            if job.state == "downloading":
+                job.close()
+
+        failed = [job for job in self.jobs if job.state != "complete"]
+        if failed:
+            logging.error(f"{len(failed)} of {len(self.jobs)} files failed!")
+            exit(1)
+
+        logging.info("Download complete!")
+
+    def serve(self, socket_path):
+        # Keep the peer list, origin sessions and peer connections warm, and take jobs over a local socket
+        if self.metrics_port:
+            serve_metrics(self.metrics, self.metrics_port)
+
+        self.job_ids = itertools.count(1)
+        self.prepare_pool = ThreadPoolExecutor(max_workers = self.http_pool_size)
+
+        scheduler = self.new_scheduler(keep_open = True)
+
+        # Peers come and go with the tracker subscription, the local worker is always there
+        self.peer_servers = []
+        self.start_workers(scheduler, daemon = True)
+
+        self.subscription = PeerSubscription(
+            self.tracker_ip, self.tracker_port, self.peer_list_max_age,
+            on_add = lambda addr: self.peer_joined(scheduler, addr), on_remove = self.peer_left
+        )
+        self.subscription.start()
+
+        if not self.subscription.wait_synced(self.peer_list_max_age):
+            logging.error("Tracker not reachable, downloading without peers until it is!")
+
+        sock = self.bind_job_socket(socket_path)
+        logging.info(f"Accepting jobs on {socket_path}")
+
+        # Stop the same way on SIGTERM as on Ctrl-C
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, stop)
+
+        try:
+            while True:
+                io, _ = sock.accept()
+                threading.Thread(target = self.job_handler, args = (scheduler, io), daemon = True).start()
+
+        except KeyboardInterrupt:
+            logging.info("Shutting down!")
+
+        finally:
+            sock.close()
+            os.remove(socket_path)
+
+            # Unfinished jobs keep their manifests and resume when submitted again
+            scheduler.close()
+            self.close_peer_connections()
+            with self.submitted_lock:
+                for job in self.submitted.values():
+                    if job.state == "downloading":
+                        job.checkpoint(force = True)
+            self.peer_stats.save()
+
+    def peer_joined(self, scheduler, addr):
+        peer = peer_name(*addr)
+        self.peer_addrs[peer] = addr
+        self.peer_servers = [peer_name(*addr) for addr in self.subscription.live_peers()]
+        self.start_peer_worker(scheduler, peer, daemon = True)
+
+    def peer_left(self, addr):
+        peer = peer_name(*addr)
+        self.peer_servers = [peer_name(*addr) for addr in self.subscription.live_peers()]
+        if peer in self.peer_stops:
+            self.peer_stops.pop(peer).set()
+
+    def bind_job_socket(self, socket_path):
+        if os.path.exists(socket_path):
+            # Only replace a socket left behind by a daemon that is gone
+            try:
+                request(socket_path, {'op': "status", 'id': 0})
+                logging.error(f"A daemon is already running on {socket_path}! Exiting!")
+                exit(1)
+            except OSError:
+                if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                    logging.error(f"{socket_path} is not a socket! Exiting!")
+                    exit(1)
+                os.remove(socket_path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(socket_path)
+        sock.listen()
+        return sock
+
+    def job_handler(self, scheduler, io):
+        try:
+            message = recv_message(io)
+            if message.get('op') == "submit":
+                reply = self.submit(scheduler, message)
+            elif message.get('op') == "status":
+                reply = self.status(message.get('id'))
+            else:
+                reply = {'error': "Unknown request!"}
+            send_message(io, reply)
+
+        except (OSError, ValueError, AttributeError) as e:
+            logging.error(f"Job request failed: {e}")
+
+        finally:
+            io.close()
+
+    def submit(self, scheduler, message):
+        if not message.get('url') or not message.get('path'):
+            return {'error': "Jobs need a URL and a path!"}
+
+        job = DownloadJob(message['url'], message['path'], message.get('sha256'), next(self.job_ids), message.get('mirrors'))
+
+        with self.submitted_lock:
+            if any(other.path == job.path and other.state in ("queued", "downloading") for other in self.submitted.values()):
+                return {'error': f"{job.path} is already being downloaded!"}
+
+            self.submitted[job.id] = job
+
+            # Forget the oldest finished jobs
+            finished = [i for i, other in self.submitted.items() if other.state in ("complete", "failed")]
+            for i in finished[:max(0, len(self.submitted) - JOB_HISTORY)]:
+                del self.submitted[i]
+
+        logging.info(f"Job {job.id}: {job.url} -> {job.path}")
+        self.prepare_pool.submit(self.launch_job, scheduler, job)
+        return {'id': job.id}
+
+    def launch_job(self, scheduler, job):
+        if self.prepare_job(job):
+            self.start_job(scheduler, job)
+
+    def status(self, job_id = None):
+        with self.submitted_lock:
+            if job_id is None:
+                jobs = list(self.submitted.values())
+            else:
+                jobs = [self.submitted[job_id]] if job_id in self.submitted else []
+
+        return {'jobs': [job.status() for job in jobs], 'peers': self.peer_servers, 'tracker_age': self.subscription.age()}
+
+    def finish_range(self, scheduler, name, chunk, download_range, received, elapsed = None, request_id = None):
+        # elapsed is the time since the range was requested, request_id its ID on the peer connection
+        self.metrics.inc("bytes_total", received, peer = name)
+
+        # Complete the chunk if the whole range arrived, otherwise hand the rest back
+        if received == download_range[1] - download_range[0] + 1:
+            first = scheduler.complete(chunk, name)
+            self.metrics.inc("ranges_total", result = "complete" if first else "duplicate")
+            if elapsed is not None:
+                self.metrics.observe("chunk_seconds", elapsed, peer = name)
+            self.trace_chunk("done", chunk, peer = name, request = request_id, bytes = received, seconds = elapsed, result = "complete" if first else "duplicate")
+
+            if first:
+                job, i = chunk
+                logging.info(f"Range {download_range} done! -> {received} bytes")
+                if job.complete(i):
+                    self.close_job(scheduler, job)
+            return True
+
+        self.fail_range(scheduler, name, chunk, (download_range[0] + received, download_range[1]), request_id)
+        return False
+
+    def fail_range(self, scheduler, name, chunk, remaining, request_id = None):
+        self.metrics.inc("ranges_total", result = "failed")
+        self.trace_chunk("fail", chunk, peer = name, request = request_id, remaining = list(remaining))
+
+        # Hand the rest of a chunk back, settling its job if it was given up on
+        if scheduler.fail(chunk, remaining, name):
+            job, i = chunk
+            logging.error(f"Giving up on range {remaining} of {job.path}!")
+            self.trace_chunk("give_up", chunk)
+            if job.give_up(i):
+                self.close_job(scheduler, job)
+
+    def close_peer_connections(self):
+        with self.peer_socks_lock:
+            for sock in self.peer_socks:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def client_worker(self, scheduler):
+
+        # Keep pulling chunks until there is nothing left to download or hedge
+        while True:
+            chunk = scheduler.next_chunk(LOCAL, wait = True)
+            if chunk is None:
+                return
+
+            key, download_range = chunk
+            start = time.monotonic()
+            received = self.client_downloader(scheduler, key, download_range)
+            elapsed = time.monotonic() - start
+
+            # Track throughput for sizing ranges of the next job
+            if self.finish_range(scheduler, LOCAL, key, download_range, received, elapsed):
+                self.peer_stats.record(LOCAL, received, elapsed)
+
+    def server_worker(self, peer, scheduler, stop):
+
+        # Reconnect after failures, giving up on the peer after max_retries in a row or once it leaves.
+        # The daemon keeps retrying instead, a peer that is gone for good leaves the tracker's list.
+        failures = 0
+        while (failures <= self.max_retries or scheduler.open) and not stop.is_set():
+            completed = self.peer_session(peer, scheduler, stop)
+            if completed is None:
+                return
+
+            failures = 0 if completed else failures + 1
+            if scheduler.wait_finished(min(2 ** failures, 10)):
+                return
+
+        if not stop.is_set():
+            logging.error(f"Giving up on peer server {peer}!")
 
+    def peer_session(self, peer, scheduler, stop):
+        # Returns None once there is nothing left, or the number of chunks completed before the connection failed
+        buf = memoryview(bytearray(MAX_FRAME_PAYLOAD))
+        session = PeerSession(self, peer, scheduler)
+        sock = None
+
+        try:
+            sock = self.connect_peer(peer)
+
+            while True:
+                # Keep the pipeline full, only stealing or hedging other peers' chunks when idle
+                while len(session.inflight) < self.pipeline_depth:
+                    chunk = scheduler.next_chunk(peer, steal = not session.inflight, wait = not session.inflight, cancel = stop)
+                    if chunk is None:
+                        break
+
+                    request_id = session.add(chunk)
+
+                    # The peer may have closed the connection while it sat idle
+                    if len(session.inflight) == 1 and is_dropped(sock):
+                        self.disconnect_peer(sock)
+                        sock = self.connect_peer(peer)
+
+                    sock.sendall(session.request(request_id))
+
+                if not session.inflight:
+                    return None
+
+                # Receive data frames from peer server into a reusable buffer
+                header = session.check_header(parse_frame_header(recv_exact(sock, FRAME_HEADER.size)))
+                type, flags, request_id, offset, length, payload_len = header
+
+                payload = None
+                if type == FRAME_DATA:
+                    payload = self.receive_frame_payload(sock, buf, payload_len, flags, length)
+                elif type == FRAME_ERROR:
+                    payload = recv_exact(sock, payload_len)
+
+                session.handle_frame(header, payload)
+
+        except OSError as e:
+            logging.error(f"Connection to peer server {peer} failed: {e}")
+            session.hand_back()
+            return session.completed
+
+        finally:
+            session.close()
+            if sock:
+                self.disconnect_peer(sock)
+
+    def peer_address(self, peer):
+        # (IP, port) of a peer server by its name
+        ip, port = self.peer_addrs.get(peer, (peer, 0))
+        return (ip, port or self.server_port)
+
+    def connect_peer(self, peer):
+        # One connection carries all chunks for this peer, from an ephemeral port, to the port
+        # the peer reported or SERVER_PORT. A peer that sends nothing for progress_timeout seconds counts as failed.
+        address = self.peer_address(peer)
+        sock = socket.create_connection(address, timeout = self.progress_timeout)
+
+        if self.compression and peer not in self.plain_peers and not self.negotiate(sock, peer):
+            # Peers that predate negotiation drop the connection, talk to them uncompressed from now on
+            sock.close()
+            self.plain_peers.add(peer)
+            sock = socket.create_connection(address, timeout = self.progress_timeout)
+
+        with self.peer_socks_lock:
+            self.peer_socks.add(sock)
+        logging.info(f"Connected to peer server {peer}")
+        return sock
+
+    def negotiate(self, sock, peer):
+        # Offer our codec, returns False if the peer does not understand the offer
         client_proto = ClientProtocol()
-        # Generate packet for range download
-        range_sender = client_proto.gen_download_range(self.url, range)
+        sock.sendall(client_proto.gen_hello([self.compression]))
 
-        # Connect to peer server
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(('', self.client_server_port))
-        sock.settimeout(10000000)
-        sock.connect((self.peer_servers[i], self.server_port))
+        header = parse_frame_header(recv_exact(sock, FRAME_HEADER.size))
+        codec = header and client_proto.get_hello(header, recv_exact(sock, header[5]))
+        if codec is False:
+            return False
 
-        # Send download range
-        sock.send(range_sender.encode())
+        logging.info(f"Compression with peer server {peer}: {codec or 'none'}")
+        return True
 
-        # Receive data from peer server
-        data = b""
-        while len(data) < (range[1] - range[0] + 2):
-            data += sock.recv(1024)
-        
-        downloaded_data = client_proto.get_downloaded_data(data)
+    def disconnect_peer(self, sock):
+        with self.peer_socks_lock:
+            self.peer_socks.discard(sock)
+        sock.close()
+    
+    def client_downloader(self, scheduler, key, range):
+        logging.info(f"Downloading locally for range {range}")
 
-        if not downloaded_data:
-            logging.error("Data not received!")
-            exit(1)
-        
-        results[i] = downloaded_data
+        # Download locally from the best mirror, writing each block at its offset
+        job = key[0]
+        url = job.mirrors.acquire()
+        offset = range[0]
+        start = time.monotonic()
+        failed = False
+        try:
+            with self.session.get(url, headers = {"Range" : f"bytes={range[0]}-{range[1]}"}, stream = True, timeout = self.progress_timeout) as r:
+                r.raise_for_status()
+
+                # Anything but the start of the file must be the part asked for, not the whole file
+                content_range = r.headers.get("Content-Range", "")
+                if range[0] and (r.status_code != 206 or (content_range and not content_range.startswith(f"bytes {range[0]}-"))):
+                    raise requests.HTTPError(f"{url} ignored the range request!", response = r)
+
+                for block in r.iter_content(chunk_size = BLOCK_SIZE):
+                    if scheduler.is_done(key):
+                        # A hedge finished this range first
+                        break
+
+                    # Nothing past the end of the range is written, even if the server sends more
+                    block = block[:(range[1] + 1 - offset)]
+                    job.land(offset, block)
+                    offset += len(block)
+                    if offset > range[1]:
+                        break
+
+        except requests.RequestException as e:
+            logging.error(f"Local download of range {range} from {url} failed: {e}")
+            failed = True
 
-        logging.info(f"Range {range} done! -> {len(results[i])} bytes")
+        finally:
+            job.mirrors.release(url, offset - range[0], time.monotonic() - start, failed)
+
+        return offset - range[0]
     
-    def merge_and_save(self, results):
+    def receive_frame_payload(self, sock, buf, size, flags, length):
+        # Returns the payload, decompressed, or None if it is corrupt or its checksum does not match
+        if size > len(buf) or length > len(buf):
+            raise ConnectionError(f"Frame of {max(size, length)} bytes exceeds {len(buf)}!")
 
-        # Merge received data
-        logging.info(f"Received all data, merging!")
-        with open(str(self.path), "wb") as f:
-            for part in results:
-                f.write(part)
+        view = buf[:size]
+        if recv_into_exact(sock, view) != size:
+            raise ConnectionError("Connection closed mid-frame!")
 
-        logging.info("Download complete!")
+        trailer = recv_exact(sock, CHECKSUM.size) if flags & FLAG_CRC32 else None
+
+        if flags & FLAG_ZLIB:
+            view = decompress_frame(view, length)
+            if view is None:
+                return None
+
+        if trailer is not None and not verify_checksum(view, trailer):
+            return None
+
+        return view
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description = "Peer Client")
     parser.add_argument("-c", "--config", help = "Path to config file", required = False, default = ".config")
     parser.add_argument("-d", "--debug", help = "Debug Mode", required = False, default = False)
+    parser.add_argument("-D", "--daemon", help = "Keep running and take jobs from peer_submit.py", action = "store_true")
 
     args = parser.parse_args()
 
@@ -197,6 +980,9 @@ if __name__ == "__main__":
                 elif line.split(" ")[0] == "PATH":
                     configuration['path'] = line.split(" ")[-1].strip("\n")
 
+                elif line.split(" ")[0] == "MIRROR":
+                    configuration.setdefault('mirrors', []).append(line.split(" ")[-1].strip("\n"))
+
                 elif line.split(" ")[0] == "CLIENT_SERVER_PORT":
                     configuration['client_server_port'] = line.split(" ")[-1].strip("\n")
 
@@ -206,6 +992,60 @@ if __name__ == "__main__":
                 elif line.split(" ")[0] == "SERVER_CLIENT_PORT":
                     configuration['server_port'] = line.split(" ")[-1].strip("\n")
 
+                elif line.split(" ")[0] == "CHUNK_SIZE":
+                    configuration['chunk_size'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "STATS_PATH":
+                    configuration['stats_path'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "PIPELINE_DEPTH":
+                    configuration['pipeline_depth'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "HTTP_POOL_SIZE":
+                    configuration['http_pool_size'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "PROGRESS_TIMEOUT":
+                    configuration['progress_timeout'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "MAX_RETRIES":
+                    configuration['max_retries'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "HEDGE_DELAY":
+                    configuration['hedge_delay'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "SHA256":
+                    configuration['sha256'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "BATCH":
+                    configuration['batch'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "DAEMON_SOCKET":
+                    configuration['daemon_socket'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "PEER_LIST_MAX_AGE":
+                    configuration['peer_list_max_age'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "PEER_COUNT":
+                    configuration['peer_count'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "PEER_SELECTION":
+                    configuration['peer_selection'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "ENGINE":
+                    configuration['engine'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "MAX_INFLIGHT":
+                    configuration['max_inflight'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "COMPRESSION":
+                    configuration['compression'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "CLIENT_METRICS_PORT":
+                    configuration['metrics_port'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "CLIENT_TRACE_PATH":
+                    configuration['trace_path'] = line.split(" ")[-1].strip("\n")
+
     except:
         logging.error("Invalid config file!")
         exit(1)
@@ -213,11 +1053,32 @@ if __name__ == "__main__":
     try:
         c = Client(
             tracker_ip = configuration['tracker_ip'], tracker_port = configuration['tracker_port'], 
-            path = configuration['path'], url = configuration['url'],
+            path = configuration.get('path'), url = configuration.get('url'), mirrors = configuration.get('mirrors'),
             client_server_port = configuration['client_server_port'], client_tracker_port = configuration['client_tracker_port'], 
-            server_port = configuration['server_port']
+            server_port = configuration['server_port'],
+            chunk_size = configuration.get('chunk_size', 4 * 1024 * 1024),
+            stats_path = configuration.get('stats_path', ".peer_stats"),
+            pipeline_depth = configuration.get('pipeline_depth', 2),
+            http_pool_size = configuration.get('http_pool_size', 16),
+            progress_timeout = configuration.get('progress_timeout', 30),
+            max_retries = configuration.get('max_retries', 3),
+            hedge_delay = configuration.get('hedge_delay', 5),
+            sha256 = configuration.get('sha256'),
+            batch = configuration.get('batch'),
+            peer_list_max_age = configuration.get('peer_list_max_age', 30),
+            peer_count = configuration.get('peer_count', 0),
+            peer_selection = configuration.get('peer_selection', "load"),
+            engine = configuration.get('engine', "threads"),
+            max_inflight = configuration.get('max_inflight', 256),
+            compression = configuration.get('compression', "none"),
+            metrics_port = configuration.get('metrics_port', 0),
+            trace_path = configuration.get('trace_path')
         )
-        c.run()
+
+        if args.daemon:
+            c.serve(configuration.get('daemon_socket', DAEMON_SOCKET))
+        else:
+            c.run()
 
     except Exception as e:
         logging.error(e)
\ No newline at end of file
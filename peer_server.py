@@ -1,121 +1,531 @@
+import os
 import socket
 import argparse
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from utils.packet_utils import ServerProtocol
+from utils.packet_utils import ServerProtocol, FRAME_HEADER, FRAME_RANGE, FRAME_HELLO, FLAG_CRC32, FLAG_ZLIB, CHECKSUM, is_frame, parse_frame_header
 from utils.byte_utils import *
+from utils.socket_utils import recv_exact
+from utils.http_utils import make_session
+from utils.chunk_cache import ChunkCache, CACHE_BLOCK
+from utils.single_flight import SingleFlight
+from utils.compression import FrameCompressor, CODECS
+from utils.segments import SegmentTuner, fetch_segments, MAX_SEGMENTS
+from utils.fair_share import FairShare
+from utils.metrics import Metrics, TraceLog, serve_metrics
+
+# Size of the blocks relayed from upstream to the client
+BLOCK_SIZE = 256 * 1024
+
+# Sends to a client blocked for longer than this count as stalls
+SEND_STALL = 0.05
 
 class Server:
-    def __init__(self, tracker_ip, tracker_port, client_port, server_client_port, server_tracker_port):
+    def __init__(self, tracker_ip, tracker_port, client_port, server_client_port, server_tracker_port, max_ranges = 8, backlog = 64, heartbeat_interval = 10, max_connections = 64, http_pool_size = 16, cache_memory = 0, cache_disk = 0, cache_dir = ".chunk_cache", cache_chunk = 4 * 1024 * 1024, client_timeout = 300, coalesce = 1, compression = "zlib", segments = 0, segment_size = 1024 * 1024, egress_limit = 0, client_egress_limit = 0, client_weights = None, metrics_port = 0, trace_path = None):
         self.tracker_ip = tracker_ip
         self.tracker_port = int(tracker_port)
         self.client_port = int(client_port)
         self.server_client_port = int(server_client_port)
         self.server_tracker_port = int(server_tracker_port)
+        self.max_ranges = int(max_ranges)
+        self.backlog = int(backlog)
+        self.max_connections = int(max_connections)
+        self.heartbeat_interval = float(heartbeat_interval)
+        self.client_timeout = float(client_timeout)
+        self.server_proto = ServerProtocol()
+        self.tracker_lock = threading.Lock()
+        self.session = make_session(http_pool_size)
+        self.cache_chunk = int(cache_chunk)
+        self.compression = compression
+
+        # Load reported to the tracker: ranges in flight or waiting for a slot, bytes sent and their recent rate
+        self.load_lock = threading.Lock()
+        self.inflight = 0
+        self.bytes_sent = 0
+        self.throughput = 0
+
+        # Optional chunk cache, in memory with a disk spill tier
+        if int(cache_memory) or int(cache_disk):
+            self.cache = ChunkCache(cache_memory, cache_disk, cache_dir)
+        else:
+            self.cache = None
+
+        # Overlapping requests share one upstream fetch per chunk
+        if int(coalesce):
+            self.flights = SingleFlight()
+            self.fetch_pool = ThreadPoolExecutor(max_workers = self.max_ranges)
+        else:
+            self.flights = None
+
+        # Upstream ranges longer than a segment are fetched as concurrent sub-ranges, 0 tunes the count per origin
+        self.segments = int(segments)
+        self.segment_size = int(segment_size)
+        self.tuner = SegmentTuner()
+        self.segment_pool = ThreadPoolExecutor(max_workers = self.max_ranges * (self.segments or MAX_SEGMENTS))
+
+        # Range slots go to clients in weighted fair order, and their sends are paced by the egress limits
+        self.fair = FairShare(self.max_ranges, egress_limit, client_egress_limit, client_weights)
+
+        self.metrics_port = int(metrics_port)
+        self.trace = TraceLog(trace_path) if trace_path else None
+        self.define_metrics()
+
+    def define_metrics(self):
+        m = self.metrics = Metrics("peer_server")
+        m.gauge("ranges_in_flight", "Ranges being served or waiting for a slot", collect = lambda: self.inflight)
+        m.gauge("ranges_waiting", "Ranges waiting for a slot", collect = lambda: self.fair.stats()['waiting'])
+        m.gauge("throughput_bytes_per_second", "Send rate reported to the tracker", collect = lambda: int(self.throughput))
+        m.counter("ranges_total", "Ranges served by result")
+        m.histogram("slot_wait_seconds", "Time ranges waited for a slot")
+        m.histogram("range_seconds", "Time from receiving a range request to its last frame")
+        m.counter("upstream_requests_total", "Upstream requests by HTTP status")
+        m.histogram("upstream_ttfb_seconds", "Time from an upstream request to its response headers")
+        m.counter("upstream_bytes_total", "Bytes fetched from upstream")
+        m.counter("bytes_relayed_total", "Bytes sent to clients")
+        m.counter("throttle_seconds_total", "Time sends waited for the egress limits")
+        m.counter("send_stalls_total", f"Sends to clients that blocked for over {SEND_STALL} seconds")
+        m.counter("send_stall_seconds_total", "Time spent in stalled sends to clients")
+        if self.cache:
+            m.gauge("cache", "Chunk cache hits, misses and size", collect = self.cache.stats, label = "stat")
+        if self.flights:
+            m.gauge("fetches", "Upstream fetches, coalesced requests and fetches in flight", collect = self.flights.stats, label = "stat")
+
+    def record_send(self, size, throttled, sending):
+        self.metrics.inc("bytes_relayed_total", size)
+        if throttled > 0:
+            self.metrics.inc("throttle_seconds_total", throttled)
+        if sending >= SEND_STALL:
+            self.metrics.inc("send_stalls_total")
+            self.metrics.inc("send_stall_seconds_total", sending)
     
     def run(self):
+        if self.metrics_port:
+            serve_metrics(self.metrics, self.metrics_port)
+
         # Connect to tracker
         self.connect_to_tracker()
 
+        # Keep our registration alive on the tracker
+        threading.Thread(target = self.heartbeat, daemon = True).start()
+
         # Listen for connections from client
-        self.listener()
+        try:
+            self.listener()
+        finally:
+            # Deregister from tracker on shutdown
+            self.kill()
     
     def connect_to_tracker(self):
-        self.server_proto = ServerProtocol()
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(('', self.server_tracker_port))
-        sock.connect((self.tracker_ip, self.tracker_port))
-
-        # Send handshake to tracking server
-        handshake = self.server_proto.gen_handshake()
-        sock.send(handshake.encode())
-
-        # Validate received handshake
-        data = sock.recv(1024)
-        if not self.server_proto.validate_handshake(data):
+        # Send request to add peer
+        if not self.tracker_request(self.server_proto.add_peer(self.load())):
             logging.error("Invalid handshake! Exiting!")
             exit(1)
-        else:
-            logging.info("Validated handshake!")
-        
-        # Send request to add peer
-        add_req = self.server_proto.add_peer()
-        sock.send(add_req.encode())
 
-        sock.shutdown(socket.SHUT_RDWR)
-        sock.close()
+    def load(self):
+        with self.load_lock:
+            return (self.inflight, self.max_ranges, int(self.throughput), self.server_client_port)
+
+    def measure(self, elapsed):
+        # Smooth the send rate over the last heartbeat interval into the reported throughput
+        with self.load_lock:
+            rate = self.bytes_sent / elapsed if elapsed > 0 else 0
+            self.throughput = rate if not self.throughput else 0.5 * self.throughput + 0.5 * rate
+            self.bytes_sent = 0
+
+    def heartbeat(self):
+        last = time.monotonic()
+        while True:
+            time.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            self.measure(now - last)
+            last = now
+
+            try:
+                if not self.tracker_request(self.server_proto.heartbeat(self.load())):
+                    logging.error("Heartbeat rejected by tracker!")
+            except OSError as e:
+                logging.error(f"Heartbeat failed: {e}")
+
+            if self.cache:
+                logging.info(f"Cache stats: {self.cache.stats()}")
+            if self.flights:
+                logging.info(f"Fetch stats: {self.flights.stats()}")
+            if not self.segments:
+                logging.info(f"Segment throughput: {self.tuner.stats()}")
+            logging.info(f"Range slots: {self.fair.stats()}")
+
+    def tracker_request(self, req):
+        with self.tracker_lock:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', self.server_tracker_port))
+            sock.connect((self.tracker_ip, self.tracker_port))
+
+            try:
+                # Send handshake to tracking server
+                handshake = self.server_proto.gen_handshake()
+                sock.send(handshake.encode())
+
+                # Validate received handshake
+                data = sock.recv(1024)
+                if not self.server_proto.validate_handshake(data):
+                    return False
+
+                logging.info("Validated handshake!")
+
+                sock.sendall(req)
+
+                # Wait for the tracker to close first, so our fixed port is not left in TIME_WAIT
+                sock.shutdown(socket.SHUT_WR)
+                sock.recv(1024)
+                return True
+
+            finally:
+                sock.close()
     
     def listener(self):
 
         # Listen for requests from peer servers
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.bind(('', self.server_client_port))
-        sock.listen(1)
+        sock.listen(self.backlog)
+
+        # Connections beyond max_connections wait in the accept backlog, and each
+        # in-flight range holds a slot, so busy connections stop reading requests
+        self.connection_slots = threading.BoundedSemaphore(self.max_connections)
+
+        with ThreadPoolExecutor(max_workers = self.max_connections) as pool:
+            while True:
+                self.connection_slots.acquire()
+                io, client_addr = sock.accept()
+                pool.submit(self.handler, io, client_addr)
+
+    def handler(self, io, client_addr):
+        try:
+            io.settimeout(self.client_timeout)
+            io = self.fair.connect(io, client_addr[0], self.record_send)
+            logging.info(f"Connected to client {client_addr}")
+
+            # v2 requests start with the frame magic, anything else is a legacy request
+            data = recv_exact(io, 2)
+            if is_frame(data):
+                self.handle_frames(io, data, client_addr[0])
+            else:
+                self.handle_legacy(io, data + io.recv(1024), client_addr[0])
+
+            io.shutdown(socket.SHUT_RDWR)
+
+        except Exception as e:
+            logging.error(f"Connection to {client_addr} failed: {e}")
+
+        finally:
+            io.close()
+            self.connection_slots.release()
 
+    def handle_frames(self, io, data, client):
+
+        # Serve range requests on this connection until the client closes it
+        codec = None
         while True:
-            io, client_addr = sock.accept()
-            io.settimeout(10000000)
-            logging.info(f"Connected to client {client_addr}")
+            data += recv_exact(io, FRAME_HEADER.size - len(data))
+            if not data:
+                return
+
+            # Clients only send range requests and hellos, anything else is dropped before its payload is read
+            header = parse_frame_header(data)
+            if header and header[0] not in (FRAME_RANGE, FRAME_HELLO):
+                logging.error(f"Unexpected frame of type {header[0]}!")
+                return
+
+            payload = header and recv_exact(io, header[5])
+
+            if header and header[0] == FRAME_HELLO:
+                codec = self.negotiate(io, self.server_proto.get_hello(header, payload))
+                data = b""
+                continue
 
             # Get download range
-            data = io.recv(1024)
-            out = self.server_proto.get_ranges(data)
+            out = header and self.server_proto.get_range_request(header, payload)
 
             if not out:
                 logging.error("Invalid download range!")
-                exit(1)
+                return
+
+            url, ranges, request_id, validator = out
 
-            url = b2s(out[0])
-            ranges = out[1]
-            
             logging.info(f"Received download URL {url}")
             logging.info(f"Received download range {ranges}")
 
-            # Download with URL and range
-            data = self.download(url, ranges)
+            with self.load_lock:
+                self.inflight += 1
+
+            start = time.monotonic()
+            waited = None
+            sent = 0
+            result = "aborted"
+            try:
+                with self.fair.slot(client, ranges[1] - ranges[0] + 1):
+                    waited = time.monotonic() - start
+                    sent = self.serve_range(io, url, validator, ranges, request_id, codec)
+                    result = "error" if sent is None else "complete"
+            finally:
+                with self.load_lock:
+                    self.inflight -= 1
+                    self.bytes_sent += sent or 0
+                self.record_range(client, request_id, url, ranges, waited, time.monotonic() - start, sent or 0, result)
+
+            data = b""
+
+    def record_range(self, client, request_id, url, ranges, waited, elapsed, sent, result):
+        self.metrics.inc("ranges_total", result = result)
+        self.metrics.observe("range_seconds", elapsed)
+        if waited is not None:
+            self.metrics.observe("slot_wait_seconds", waited)
+
+        # The client traces the same request ID on its side
+        if self.trace:
+            self.trace.write("range", client = client, request = request_id, url = url, range = list(ranges),
+                             wait = waited, seconds = elapsed, bytes = sent, result = result)
+
+    def negotiate(self, io, offered):
+        # Pick the codec we allow if the client offered it, and tell the client
+        codec = self.compression if self.compression in CODECS and self.compression in (offered or []) else ""
+        io.sendall(self.server_proto.gen_hello(codec))
+        logging.info(f"Compression: {codec or 'none'}")
+        return FrameCompressor() if codec else None
+
+    def serve_range(self, io, url, validator, ranges, request_id, codec = None):
+        if codec:
+            codec.reset()
+
+        try:
+            # Chunks can only be cached when the client told us which version of the file it wants
+            if self.cache and validator:
+                sent = self.serve_chunked(io, url, validator, ranges, request_id, codec)
+            elif self.flights:
+                sent = self.serve_spans(io, url, validator, ranges, request_id, codec)
+            else:
+                sent = self.serve_upstream(io, url, ranges, request_id, codec)
+
+        except requests.RequestException as e:
+            # Upstream failed, the connection itself is still usable
+            logging.error(f"Range {ranges} failed: {e}")
+            io.sendall(self.server_proto.gen_error_frame(request_id, str(e)))
+            return None
+
+        io.sendall(self.server_proto.gen_end_frame(request_id, ranges[0], sent))
+        return sent
+
+    def serve_upstream(self, io, url, ranges, request_id, codec = None):
+
+        # Relay data frames back to peer client as they arrive from upstream
+        offset = ranges[0]
+        for block in self.download(url, ranges):
+            self.send_block(io, request_id, offset, memoryview(block), codec = codec and codec.next_frame())
+            offset += len(block)
+
+        return offset - ranges[0]
+
+    def serve_chunked(self, io, url, validator, ranges, request_id, codec = None):
+
+        # Serve the range chunk by chunk, out of the cache or the one upstream fetch of each aligned chunk
+        offset = ranges[0]
+        while offset <= ranges[1]:
+            chunk_start = offset - offset % self.cache_chunk
+            key = (url, validator, chunk_start)
+
+            hit = self.cache.get(key)
+            if hit:
+                entry, f = hit
+                try:
+                    sent = self.send_entry(io, request_id, entry, f, chunk_start, offset, ranges[1], codec)
+                finally:
+                    if f:
+                        f.close()
+            elif self.flights:
+                sent = self.send_flight(io, request_id, self.fetch_flight(url, validator, chunk_start, self.cache_chunk), offset, ranges[1], codec)
+            else:
+                data = b"".join(self.download(url, (chunk_start, chunk_start + self.cache_chunk - 1)))
+                entry = self.cache.put(key, data)
+                sent = self.send_entry(io, request_id, entry, None, chunk_start, offset, ranges[1], codec)
+
+            if not sent:
+                break
+            offset += sent
+
+        return offset - ranges[0]
+
+    def serve_spans(self, io, url, validator, ranges, request_id, codec = None):
+
+        # Without the cache only the range itself is fetched, up to a chunk at a time,
+        # joining any fetch of the file already in flight that covers the next offset
+        offset = ranges[0]
+        while offset <= ranges[1]:
+            flight = self.fetch_flight(url, validator, offset, min(ranges[1] + 1 - offset, self.cache_chunk))
+            sent = self.send_flight(io, request_id, flight, offset, ranges[1], codec)
+            offset += sent
+
+            if offset < min(ranges[1] + 1, flight.start + len(flight.buf)):
+                # Fetch ended early, past the end of the file
+                break
+
+        return offset - ranges[0]
+
+    def fetch_flight(self, url, validator, start, size):
+        # Attach to a fetch in flight that covers start, or start one
+        flight, leader = self.flights.join((url, validator), start, size)
+        if leader:
+            self.fetch_pool.submit(self.run_flight, url, validator, flight)
+        return flight
+
+    def run_flight(self, url, validator, flight):
+        try:
+            for block in self.download(url, (flight.start, flight.start + len(flight.buf) - 1)):
+                flight.write(block)
+            flight.finish()
+
+            # Cache before leaving the table, so later requests find the chunk in one or the other
+            if self.cache and validator:
+                self.cache.put((url, validator, flight.start), flight.view(0, flight.filled))
+
+        except Exception as e:
+            flight.finish(e)
+
+        finally:
+            self.flights.land((url, validator), flight)
+
+    def send_flight(self, io, request_id, flight, start, end, codec = None):
+
+        # Send [start, end] out of a fetch while it is running, a block at a time
+        offset = start - flight.start
+        stop = min(end + 1 - flight.start, len(flight.buf))
+        while offset < stop:
+            block_end = min((offset // CACHE_BLOCK + 1) * CACHE_BLOCK, stop)
+            filled = flight.wait(block_end)
+            if filled <= offset:
+                # Fetch ended early, past the end of the file
+                break
+
+            size = min(block_end, filled) - offset
+            self.send_block(io, request_id, flight.start + offset, flight.view(offset, offset + size), codec = codec and codec.next_frame())
+            offset += size
+
+        return offset - (start - flight.start)
+
+    def send_entry(self, io, request_id, entry, f, chunk_start, start, end, codec = None):
+
+        # Send [start, end] out of a cached chunk, checksum blocks that line up are not recomputed.
+        # Whole blocks on disk go out with sendfile, unless they are to be compressed.
+        offset = start - chunk_start
+        stop = min(end + 1 - chunk_start, entry.size)
+        while offset < stop:
+            block = offset // CACHE_BLOCK
+            block_end = min((block + 1) * CACHE_BLOCK, entry.size)
+            size = min(block_end, stop) - offset
+            crc = entry.crcs[block] if offset == block * CACHE_BLOCK and offset + size == block_end else None
+            frame_codec = codec and codec.next_frame()
+
+            if f and crc is not None and not frame_codec:
+                # Whole block straight from disk
+                io.sendall(self.server_proto.gen_data_frame_header(request_id, chunk_start + offset, size))
+                io.sendfile(f, offset, size)
+                io.sendall(CHECKSUM.pack(crc))
+            elif f:
+                self.send_block(io, request_id, chunk_start + offset, memoryview(os.pread(f.fileno(), size, offset)), crc, frame_codec)
+            else:
+                self.send_block(io, request_id, chunk_start + offset, memoryview(entry.data)[offset:(offset + size)], crc, frame_codec)
+
+            offset += size
+
+        return max(stop - (start - chunk_start), 0)
+
+    def send_block(self, io, request_id, offset, view, crc = None, codec = None):
+        # The checksum always covers the uncompressed data
+        trailer = CHECKSUM.pack(crc) if crc is not None else self.server_proto.gen_checksum(view)
+
+        data = codec.compress(view) if codec else None
+        if data:
+            io.sendall(self.server_proto.gen_data_frame_header(request_id, offset, len(data), FLAG_CRC32 | FLAG_ZLIB, len(view)))
+            io.sendall(data)
+        else:
+            io.sendall(self.server_proto.gen_data_frame_header(request_id, offset, len(view)))
+            io.sendall(view)
 
-            # Send data back to peer client
-            packet = self.server_proto.gen_data_packet(data)
-            for i in range(0, len(packet), 1024):
-                if (i + 1024 > len(packet)):
-                    io.send(packet[i:len(packet)])
-                else:
-                    io.send(packet[i:i+1024])
+        io.sendall(trailer)
 
-            io.shutdown(socket.SHUT_RDWR)
-            io.close()
+    def handle_legacy(self, io, data, client):
+
+        # Get download range
+        out = self.server_proto.get_ranges(data)
+
+        if not out:
+            logging.error("Invalid download range!")
+            return
+
+        url = b2s(out[0])
+        ranges = out[1]
+        
+        logging.info(f"Received download URL {url}")
+        logging.info(f"Received download range {ranges}")
+
+        # Relay data back to peer client as it arrives from upstream
+        with self.fair.slot(client, ranges[1] - ranges[0] + 1):
+            io.sendall(self.server_proto.gen_data_header())
+            for block in self.download(url, ranges):
+                io.sendall(memoryview(block))
 
-    
     def download(self, url, ranges):
 
-        # Download with given range
-        logging.info("Downloading!")
-        r = requests.get(url, headers = {"Range" : f"bytes={ranges[0]}-{ranges[1]}"})
+        # Stream download with given range, in segments fetched side by side if it spans more than one
+        count = self.segments or self.tuner.count(url)
+        split = ranges[1] - ranges[0] + 1 > self.segment_size
+
+        logging.info(f"Downloading in {count if split else 1} segment(s)!")
+        if count > 1 and split:
+            blocks = fetch_segments(lambda segment, cancel: self.fetch(url, segment, cancel), self.segment_pool, ranges, count, self.segment_size)
+        else:
+            blocks = self.fetch(url, ranges)
+
+        start = time.monotonic()
+        size = 0
+        for block in blocks:
+            size += len(block)
+            yield block
+
+        # Only ranges that could have been split tell how many segments pay off
+        if not self.segments and size > self.segment_size:
+            self.tuner.record(url, count, size, time.monotonic() - start)
 
         logging.info("Download complete!")
-        return r.content
+
+    def fetch(self, url, ranges, cancel = None):
+        start = time.monotonic()
+        with self.session.get(url, headers = {"Range" : f"bytes={ranges[0]}-{ranges[1]}"}, stream = True) as r:
+            self.metrics.observe("upstream_ttfb_seconds", time.monotonic() - start)
+            self.metrics.inc("upstream_requests_total", status = r.status_code)
+            r.raise_for_status()
+
+            # Anything but the start of the file must be the part asked for, not the whole file
+            content_range = r.headers.get("Content-Range", "")
+            if (ranges[0] or cancel is not None) and (r.status_code != 206 or (content_range and not content_range.startswith(f"bytes {ranges[0]}-"))):
+                raise requests.HTTPError(f"{url} ignored the range request!", response = r)
+
+            for block in r.iter_content(chunk_size = BLOCK_SIZE):
+                if cancel is not None and cancel.is_set():
+                    return
+                self.metrics.inc("upstream_bytes_total", len(block))
+                yield block
     
     def kill(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(('', self.server_tracker_port))
-        sock.connect((self.tracker_ip, self.tracker_port))
-
-        # Send handshake to tracking server
-        handshake = self.server_proto.gen_handshake()
-        sock.send(handshake.encode())
-
-        # Validate received handshake
-        data = sock.recv(1024)
-        if not self.server_proto.validate(data):
-            logging.error("Something went wrong!")
-            exit(1)
-        
         # Send request to remove peer server
-        rm_req = self.server_proto.remove_peer()
-        sock.send(rm_req.encode())
-        sock.shutdown(socket.SHUT_RDWR)
-        sock.close()
+        try:
+            if not self.tracker_request(self.server_proto.remove_peer(self.server_client_port)):
+                logging.error("Something went wrong!")
+        except OSError as e:
+            logging.error(f"Could not deregister from tracker: {e}")
 
 
 if __name__ == "__main__":
@@ -148,6 +558,63 @@ if __name__ == "__main__":
                 
                 elif line.split(" ")[0] == "SERVER_TRACKER_PORT":
                     configuration['server_tracker_port'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "MAX_RANGES":
+                    configuration['max_ranges'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "MAX_CONNECTIONS":
+                    configuration['max_connections'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "HTTP_POOL_SIZE":
+                    configuration['http_pool_size'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "CLIENT_TIMEOUT":
+                    configuration['client_timeout'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "CACHE_MEMORY":
+                    configuration['cache_memory'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "CACHE_DISK":
+                    configuration['cache_disk'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "CACHE_DIR":
+                    configuration['cache_dir'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "CACHE_CHUNK":
+                    configuration['cache_chunk'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "COALESCE":
+                    configuration['coalesce'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "COMPRESSION":
+                    configuration['compression'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "SEGMENTS":
+                    configuration['segments'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "SEGMENT_SIZE":
+                    configuration['segment_size'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "EGRESS_LIMIT":
+                    configuration['egress_limit'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "CLIENT_EGRESS_LIMIT":
+                    configuration['client_egress_limit'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "SERVER_METRICS_PORT":
+                    configuration['metrics_port'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "SERVER_TRACE_PATH":
+                    configuration['trace_path'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "CLIENT_WEIGHT":
+                    configuration.setdefault('client_weights', {})[line.split(" ")[1]] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "BACKLOG":
+                    configuration['backlog'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "HEARTBEAT_INTERVAL":
+                    configuration['heartbeat_interval'] = line.split(" ")[-1].strip("\n")
     
     except:
         logging.error("Invalid config file!")
@@ -157,7 +624,19 @@ if __name__ == "__main__":
         s = Server(
             tracker_ip = configuration['tracker_ip'], tracker_port = configuration['tracker_port'],
             client_port = configuration['client_port'], server_client_port = configuration['server_client_port'],
-            server_tracker_port = configuration['server_tracker_port']
+            server_tracker_port = configuration['server_tracker_port'],
+            max_ranges = configuration.get('max_ranges', 8), backlog = configuration.get('backlog', 64),
+            heartbeat_interval = configuration.get('heartbeat_interval', 10),
+            max_connections = configuration.get('max_connections', 64),
+            http_pool_size = configuration.get('http_pool_size', 16),
+            cache_memory = configuration.get('cache_memory', 0), cache_disk = configuration.get('cache_disk', 0),
+            cache_dir = configuration.get('cache_dir', ".chunk_cache"), cache_chunk = configuration.get('cache_chunk', 4 * 1024 * 1024),
+            client_timeout = configuration.get('client_timeout', 300), coalesce = configuration.get('coalesce', 1),
+            compression = configuration.get('compression', "zlib"),
+            segments = configuration.get('segments', 0), segment_size = configuration.get('segment_size', 1024 * 1024),
+            egress_limit = configuration.get('egress_limit', 0), client_egress_limit = configuration.get('client_egress_limit', 0),
+            client_weights = configuration.get('client_weights'),
+            metrics_port = configuration.get('metrics_port', 0), trace_path = configuration.get('trace_path')
         )
         s.run()
 
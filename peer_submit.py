@@ -0,0 +1,103 @@
+import os
+import time
+import argparse
+from utils.job_api import request, parse_batch_line, DAEMON_SOCKET
+
+# Seconds between status requests while waiting for jobs
+POLL_INTERVAL = 0.5
+
+def socket_path(config):
+    # Only the socket path is needed from the config, everything else belongs to the daemon
+    try:
+        with open(config, "r") as f:
+            for line in f.readlines():
+                if line.split(" ")[0] == "DAEMON_SOCKET":
+                    return line.split(" ")[-1].strip("\n")
+    except OSError:
+        pass
+
+    return DAEMON_SOCKET
+
+def load_jobs(args):
+    if not args.batch:
+        return [{'url': args.url, 'path': args.path, 'sha256': args.sha256, 'mirrors': args.mirror}]
+
+    # Same format as BATCH files of the peer client
+    with open(args.batch, "r") as f:
+        return [fields for fields in map(parse_batch_line, f.readlines()) if fields]
+
+def print_status(job):
+    size = job['size'] if job['size'] is not None else "?"
+    line = f"[{job['state']}] {job['path']} {job['done_bytes']}/{size} bytes"
+    print(line + (f" ({job['error']})" if job['error'] else ""), flush = True)
+
+def wait(path, ids):
+    # Print progress until every job is complete or failed, returns True if all completed
+    last = {}
+    while True:
+        jobs = [job for job in request(path, {'op': "status"})['jobs'] if job['id'] in ids]
+
+        for job in jobs:
+            if last.get(job['id']) != (job['state'], job['done_bytes']):
+                last[job['id']] = (job['state'], job['done_bytes'])
+                print_status(job)
+
+        if len(jobs) < len(ids):
+            print("Daemon lost track of some jobs!")
+            return False
+
+        if all(job['state'] in ("complete", "failed") for job in jobs):
+            return all(job['state'] == "complete" for job in jobs)
+
+        time.sleep(POLL_INTERVAL)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Submit downloads to a peer client daemon")
+    parser.add_argument("url", help = "URL of file to be downloaded", nargs = "?")
+    parser.add_argument("path", help = "Path to save output file", nargs = "?")
+    parser.add_argument("-c", "--config", help = "Path to config file", required = False, default = ".config")
+    parser.add_argument("-s", "--sha256", help = "Expected SHA-256 of the file", required = False, default = None)
+    parser.add_argument("-m", "--mirror", help = "Mirror URL of the same file, may be repeated", action = "append", default = [])
+    parser.add_argument("-b", "--batch", help = "File with one '<url> <path> [sha256] [mirror ...]' per line", required = False, default = None)
+    parser.add_argument("--status", help = "Show all jobs of the daemon", action = "store_true")
+    parser.add_argument("--no-wait", help = "Return once the jobs are submitted", action = "store_true")
+
+    args = parser.parse_args()
+    path = socket_path(args.config)
+
+    try:
+        if args.status:
+            reply = request(path, {'op': "status"})
+            print(f"Peers: {' '.join(reply['peers']) or 'none'}")
+            for job in reply['jobs']:
+                print_status(job)
+            exit(0)
+
+        if not args.batch and not (args.url and args.path):
+            parser.error("a URL and a path, or a batch file, are required")
+
+        ids = []
+        rejected = 0
+        for job in load_jobs(args):
+            # The daemon may run from another directory
+            job['path'] = os.path.abspath(job['path'])
+            reply = request(path, {'op': "submit", **job})
+            if 'error' in reply:
+                print(f"{job['path']}: {reply['error']}")
+                rejected += 1
+                continue
+            ids.append(reply['id'])
+
+        if not ids:
+            exit(1)
+
+        if args.no_wait:
+            print(" ".join(str(i) for i in ids))
+            exit(1 if rejected else 0)
+
+        exit(0 if wait(path, set(ids)) and not rejected else 1)
+
+    except OSError as e:
+        print(f"Could not reach the daemon at {path}: {e}")
+        exit(1)
@@ -0,0 +1,45 @@
+import tempfile
+import unittest
+from unittest import mock
+from utils import chunk_cache
+from utils.chunk_cache import ChunkCache
+
+class SpillTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = ChunkCache(100, 200, self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_spilled_without_lock(self):
+        # Writing a spill file must not hold up other lookups
+        locked = []
+        real_open = open
+
+        def checked_open(path, mode = "r"):
+            if "w" in mode:
+                locked.append(self.cache.lock.locked())
+            return real_open(path, mode)
+
+        with mock.patch.object(chunk_cache, "open", checked_open, create = True):
+            self.cache.put("a", b"a" * 100)
+            self.cache.put("b", b"b" * 100)
+
+        self.assertEqual(locked, [False])
+
+        entry, f = self.cache.get("a")
+        with f:
+            self.assertEqual(f.read(), b"a" * 100)
+        self.assertEqual(self.cache.get("b")[1], None)
+
+    def test_disk_evicted(self):
+        for key in "abcd":
+            self.cache.put(key, key.encode() * 100)
+
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.stats()['disk_bytes'], 200)
+        self.assertEqual(self.cache.stats()['memory_bytes'], 100)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from peer_client import Client, DownloadJob
+
+BODY = bytes(range(100)) * 3
+
+class WholeFileHandler(BaseHTTPRequestHandler):
+    # Ignores the Range header and sends the whole file
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+class IgnoredRangeTest(unittest.TestCase):
+    # The origin ignores the Range header, nothing outside the range may be written
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.server = HTTPServer(("127.0.0.1", 0), WholeFileHandler)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+        self.client = Client("127.0.0.1", 1, None, None, 0, 0, 1, stats_path = os.path.join(self.dir.name, "stats"))
+        self.path = os.path.join(self.dir.name, "file.bin")
+
+        self.job = DownloadJob(f"http://127.0.0.1:{self.server.server_port}/file.bin", self.path)
+        self.job.file_size = 200
+        self.job.validator = {'size': 200, 'etag': None, 'last_modified': None}
+        self.job.cache_validator = ""
+        self.job.download_ranges = [(0, 99), (100, 199)]
+        self.job.download_owners = None
+        self.job.load_manifest()
+
+        self.scheduler = self.client.new_scheduler()
+        self.client.start_job(self.scheduler, self.job)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.job.close()
+        self.dir.cleanup()
+
+    def test_range_in_the_middle(self):
+        self.assertEqual(self.client.client_downloader(self.scheduler, (self.job, 1), (100, 199)), 0)
+        self.assertEqual(os.path.getsize(self.path), 200)
+
+    def test_range_at_the_start(self):
+        # The start of the whole file is the start of the range, only the range is kept
+        self.assertEqual(self.client.client_downloader(self.scheduler, (self.job, 0), (0, 99)), 100)
+        self.assertEqual(os.path.getsize(self.path), 200)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(100), BODY[:100])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import random
+import hashlib
+import tempfile
+import threading
+import unittest
+from utils.digest import FileDigest
+
+class FileDigestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(1024 * 1024)
+        f = tempfile.NamedTemporaryFile(delete = False)
+        f.close()
+        self.path = f.name
+        self.fd = os.open(self.path, os.O_RDWR)
+        os.ftruncate(self.fd, len(self.data))
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.path)
+
+    def land(self, digest, blocks):
+        for offset in blocks:
+            block = self.data[offset:(offset + 4096)]
+            os.pwrite(self.fd, block, offset)
+            digest.update(offset, block)
+
+    def test_out_of_order_from_threads(self):
+        digest = FileDigest(self.fd, len(self.data))
+        blocks = list(range(0, len(self.data), 4096))
+        random.shuffle(blocks)
+
+        threads = [threading.Thread(target = self.land, args = (digest, blocks[i::4])) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(digest.hexdigest(), hashlib.sha256(self.data).hexdigest())
+
+    def test_existing_data(self):
+        os.pwrite(self.fd, self.data, 0)
+        digest = FileDigest(self.fd, len(self.data))
+        digest.add_existing(4096, len(self.data) - 1)
+        digest.update(0, self.data[:4096])
+        self.assertEqual(digest.frontier, len(self.data))
+        self.assertEqual(digest.hexdigest(), hashlib.sha256(self.data).hexdigest())
+
+if __name__ == "__main__":
+    unittest.main()
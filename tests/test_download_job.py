@@ -0,0 +1,43 @@
+import os
+import tempfile
+import threading
+import unittest
+from peer_client import DownloadJob
+
+class CloseTest(unittest.TestCase):
+    # The worker settling the last chunk and the end of the download may both close a job
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.job = DownloadJob("http://origin/file.bin", os.path.join(self.dir.name, "file.bin"))
+        self.job.file_size = 100
+        self.job.validator = {'size': 100, 'etag': None, 'last_modified': None}
+        self.job.download_ranges = [(0, 99)]
+        self.job.download_owners = None
+        self.job.load_manifest()
+        self.job.open()
+
+        self.job.land(0, b"x" * 100)
+        self.assertTrue(self.job.complete(0))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_close_twice(self):
+        self.assertTrue(self.job.close())
+        self.assertTrue(self.job.close())
+        self.assertEqual(self.job.state, "complete")
+
+    def test_concurrent_close(self):
+        results = []
+        threads = [threading.Thread(target = lambda: results.append(self.job.close())) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, [True] * 4)
+        self.assertIsNone(self.job.fd)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import time
+import unittest
+from utils.fair_share import FairShare
+
+class EgressTest(unittest.TestCase):
+
+    def test_idle_client_leaves_its_share(self):
+        # b holds a slot but sends nothing, a gets the whole limit
+        fair = FairShare(2, total_rate = 1000000)
+        fair.acquire("a", 1)
+        fair.acquire("b", 1)
+
+        start = time.monotonic()
+        for _ in range(20):
+            fair.throttle("a", 10000)
+        self.assertLess(time.monotonic() - start, 0.3)
+
+    def test_client_limit(self):
+        fair = FairShare(1, total_rate = 1000000, client_rate = 100000)
+        fair.acquire("a", 1)
+        self.assertGreater(sum(fair.throttle("a", 10000) for _ in range(5)), 0.3)
+
+    def test_handshakes_not_paced(self):
+        fair = FairShare(1, total_rate = 1000)
+        self.assertEqual(fair.throttle("a", 100000), 0)
+
+    def test_weight_must_be_positive(self):
+        self.assertRaises(ValueError, FairShare, 1, weights = {"10.0.0.1": "0"})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,19 @@
+import unittest
+from utils.packet_utils import FRAME_RANGE, FRAME_DATA, FRAME_ERROR, MAX_CONTROL_PAYLOAD, MAX_FRAME_PAYLOAD, gen_frame_header, parse_frame_header
+
+class FrameHeaderTest(unittest.TestCase):
+
+    def test_control_frame_within_cap(self):
+        header = gen_frame_header(FRAME_RANGE, 7, 0, 100, MAX_CONTROL_PAYLOAD)
+        self.assertEqual(parse_frame_header(header), (FRAME_RANGE, 0, 7, 0, 100, MAX_CONTROL_PAYLOAD))
+
+    def test_oversized_control_frame_rejected(self):
+        for type in (FRAME_RANGE, FRAME_ERROR):
+            self.assertFalse(parse_frame_header(gen_frame_header(type, 1, 0, 0, 2 ** 32 - 1)))
+
+    def test_data_frame_not_capped(self):
+        header = gen_frame_header(FRAME_DATA, 1, 0, MAX_FRAME_PAYLOAD, MAX_FRAME_PAYLOAD)
+        self.assertTrue(parse_frame_header(header))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import socket
+import unittest
+from unittest import mock
+import peer_server
+from peer_server import Server
+from utils.packet_utils import FRAME_DATA, FRAME_RANGE, MAX_CONTROL_PAYLOAD, gen_frame_header
+from utils.socket_utils import recv_exact
+
+class HandleFramesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server("127.0.0.1", 1, 1, 1, 1)
+        self.client, self.io = socket.socketpair()
+        self.io.settimeout(5)
+
+    def tearDown(self):
+        self.client.close()
+        self.io.close()
+
+    def serve(self, header):
+        # Returns the sizes the server tried to read
+        self.client.sendall(header)
+        self.client.shutdown(socket.SHUT_WR)
+        with mock.patch.object(peer_server, "recv_exact", wraps = recv_exact) as recv:
+            self.server.handle_frames(self.io, b"", "127.0.0.1")
+        return [call.args[1] for call in recv.call_args_list]
+
+    def test_data_frame_payload_not_read(self):
+        sizes = self.serve(gen_frame_header(FRAME_DATA, 1, 0, 0, 2 ** 32 - 1))
+        self.assertTrue(all(size <= MAX_CONTROL_PAYLOAD for size in sizes))
+
+    def test_oversized_range_request_not_read(self):
+        sizes = self.serve(gen_frame_header(FRAME_RANGE, 1, 0, 100, 2 ** 32 - 1))
+        self.assertTrue(all(size <= MAX_CONTROL_PAYLOAD for size in sizes))
+
+if __name__ == "__main__":
+    unittest.main()
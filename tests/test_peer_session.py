@@ -0,0 +1,69 @@
+import os
+import socket
+import asyncio
+import tempfile
+import threading
+import unittest
+from peer_client import Client, DownloadJob
+from utils.async_engine import AsyncEngine
+from utils.packet_utils import FRAME_HEADER, FRAME_END, gen_frame, parse_frame_header
+from utils.socket_utils import recv_exact
+
+class BadEndTest(unittest.TestCase):
+    # The peer ends a range short of its length and the connection is dropped
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(target = self.fake_peer, daemon = True).start()
+
+        port = self.listener.getsockname()[1]
+        self.client = Client("127.0.0.1", 1, None, None, 0, 0, port, stats_path = os.path.join(self.dir.name, "stats"))
+        self.client.peer_addrs["peer"] = ("127.0.0.1", port)
+
+        self.job = DownloadJob("http://origin/file.bin", os.path.join(self.dir.name, "file.bin"))
+        self.job.file_size = 100
+        self.job.validator = {'size': 100, 'etag': None, 'last_modified': None}
+        self.job.cache_validator = ""
+        self.job.download_ranges = [(0, 99)]
+        self.job.download_owners = None
+        self.job.load_manifest()
+
+        self.scheduler = self.client.new_scheduler()
+        self.client.start_job(self.scheduler, self.job)
+        self.key = (self.job, 0)
+
+    def tearDown(self):
+        self.listener.close()
+        self.job.close()
+        self.dir.cleanup()
+
+    def fake_peer(self):
+        io, _ = self.listener.accept()
+        with io:
+            header = parse_frame_header(recv_exact(io, FRAME_HEADER.size))
+            recv_exact(io, header[5])
+            io.sendall(gen_frame(FRAME_END, header[2], header[3], 50))
+            io.recv(1)
+
+    def assert_handed_back(self):
+        self.assertFalse(self.scheduler.inflight.get(self.key))
+        self.assertIn((self.key, (0, 99)), list(self.scheduler.pending))
+
+    def test_threads(self):
+        self.assertEqual(self.client.peer_session("peer", self.scheduler, threading.Event()), 0)
+        self.assert_handed_back()
+
+    def test_asyncio(self):
+        engine = AsyncEngine(self.client)
+
+        async def run():
+            engine.loop = asyncio.get_running_loop()
+            engine.changed = asyncio.Event()
+            return await engine.peer_session("peer", self.scheduler)
+
+        self.assertEqual(asyncio.run(run()), 0)
+        self.assert_handed_back()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from utils.scheduler import ChunkScheduler
+
+class HedgeAfterCloseTest(unittest.TestCase):
+    # The winner of a hedged chunk closes its job while the losing hedge is still running
+
+    def setUp(self):
+        self.key = ("job", 0)
+        self.scheduler = ChunkScheduler([(self.key, (0, 99))], hedge_delay = 0)
+        self.assertEqual(self.scheduler.poll("a"), (self.key, (0, 99)))
+        self.assertEqual(self.scheduler.poll("b", wait = True), (self.key, (0, 99)))
+
+        self.assertTrue(self.scheduler.complete(self.key, "a"))
+        self.scheduler.forget([self.key])
+
+    def test_loser_sees_chunk_done(self):
+        self.assertTrue(self.scheduler.is_done(self.key))
+
+    def test_loser_completing_is_a_duplicate(self):
+        self.assertFalse(self.scheduler.complete(self.key, "b"))
+        self.assertFalse(self.scheduler.is_done(self.key))
+        self.assertFalse(self.scheduler.losing)
+        self.assertTrue(self.scheduler.finished())
+
+    def test_loser_failing_is_not_requeued(self):
+        self.assertFalse(self.scheduler.fail(self.key, (50, 99), "b"))
+        self.assertFalse(self.scheduler.pending)
+        self.assertIsNone(self.scheduler.poll("c", wait = True))
+        self.assertFalse(self.scheduler.is_done(self.key))
+        self.assertTrue(self.scheduler.finished())
+
+class ForgetTest(unittest.TestCase):
+
+    def test_forget_without_hedge_drops_chunk(self):
+        key = ("job", 0)
+        scheduler = ChunkScheduler([(key, (0, 99))])
+        scheduler.poll("a")
+        self.assertTrue(scheduler.complete(key, "a"))
+        scheduler.forget([key])
+        self.assertFalse(scheduler.is_done(key))
+        self.assertFalse(scheduler.lingering)
+
+if __name__ == "__main__":
+    unittest.main()
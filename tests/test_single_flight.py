@@ -0,0 +1,28 @@
+import unittest
+from utils.single_flight import SingleFlight
+
+class JoinTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.flight, leader = self.flights.join(("url", None), 1000, 500)
+        self.assertTrue(leader)
+
+    def test_overlapping_start_joins(self):
+        self.assertEqual(self.flights.join(("url", None), 1499, 100), (self.flight, False))
+
+    def test_start_past_span_fetches(self):
+        flight, leader = self.flights.join(("url", None), 1500, 100)
+        self.assertTrue(leader)
+        self.assertEqual(flight.start, 1500)
+
+    def test_other_file_fetches(self):
+        self.assertTrue(self.flights.join(("url", "v1"), 1000, 500)[1])
+
+    def test_land(self):
+        self.flights.land(("url", None), self.flight)
+        self.assertTrue(self.flights.join(("url", None), 1000, 500)[1])
+        self.assertEqual(self.flights.stats()['in_flight'], 1)
+
+if __name__ == "__main__":
+    unittest.main()
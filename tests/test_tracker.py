@@ -0,0 +1,50 @@
+import socket
+import threading
+import unittest
+from tracker import Tracker
+from utils.packet_utils import ClientProtocol, ServerProtocol, TrackerProtocol, PEER_LIST
+from utils.socket_utils import recv_exact
+
+class RequestFramingTest(unittest.TestCase):
+    # Requests arriving together in one read are each answered
+
+    def setUp(self):
+        self.tracker = Tracker(0)
+        self.tracker.tracker_proto = TrackerProtocol()
+        self.tracker.peer_registry.heartbeat(("127.0.0.1", 8000))
+        self.io, self.remote = socket.socketpair()
+        self.thread = threading.Thread(target = self.tracker.handler, args = (self.io, ("127.0.0.1", 9000)), daemon = True)
+
+    def tearDown(self):
+        self.remote.close()
+
+    def test_pipelined_queries(self):
+        client_proto = ClientProtocol()
+        self.thread.start()
+        self.remote.sendall(client_proto.gen_handshake().encode())
+        recv_exact(self.remote, 2)
+
+        self.remote.sendall(client_proto.gen_query("page") * 2)
+        for _ in range(2):
+            total, count = client_proto.parse_peer_list(recv_exact(self.remote, PEER_LIST.size))
+            self.assertEqual((total, count), (1, 1))
+            recv_exact(self.remote, 1 + 4 + 2)
+
+        self.remote.shutdown(socket.SHUT_WR)
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+
+    def test_request_with_trailing_bytes(self):
+        server_proto = ServerProtocol()
+        self.thread.start()
+        self.remote.sendall(server_proto.gen_handshake().encode())
+        recv_exact(self.remote, 2)
+
+        self.remote.sendall(server_proto.remove_peer(8000) + b"\x00" * 16)
+        self.remote.shutdown(socket.SHUT_WR)
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertEqual(len(self.tracker.peer_registry), 0)
+
+if __name__ == "__main__":
+    unittest.main()
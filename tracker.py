@@ -1,35 +1,79 @@
+import time
 import socket
 import argparse
 import logging
-from utils.packet_utils import TrackerProtocol
+import threading
+from utils.packet_utils import TrackerProtocol, SUBSCRIBE_VERSION, PEER_LOAD, PEER_PORT, PEER_QUERY, EVENT_RESET, EVENT_ADD, EVENT_REMOVE, EVENT_SYNC
+from utils.peer_registry import PeerRegistry
+from utils.socket_utils import recv_exact
 from utils.byte_utils import *
+from utils.metrics import Metrics, serve_metrics
+
+# Seconds between keepalives on an idle subscription, well below the clients' staleness bound
+SUBSCRIPTION_KEEPALIVE = 5
+
+# Most peers sent in one peer list response, clients page through longer lists
+PEER_PAGE = 1024
 
 class Tracker:
-    def __init__(self, tracker_port):
+    def __init__(self, tracker_port, peer_ttl = 30, backlog = 64, metrics_port = 0):
         self.tracker_port = int(tracker_port)
-        self.peer_servers = []
+        self.backlog = int(backlog)
+        self.metrics_port = int(metrics_port)
+        self.peer_registry = PeerRegistry(peer_ttl)
+
+        self.metrics = Metrics("tracker")
+        self.metrics.gauge("peers", "Live peer servers", collect = lambda: len(self.peer_registry))
+        self.metrics.gauge("subscribers", "Open peer list subscriptions")
+        self.metrics.set("subscribers", 0)
+        self.metrics.counter("lookups_total", "Peer list requests by selection")
+        self.metrics.histogram("lookup_seconds", "Time to answer a peer list request")
+        self.metrics.counter("heartbeats_total", "Registrations and heartbeats of peer servers")
+        self.metrics.counter("registry_events_total", "Peer servers added, removed and expired")
 
     def run(self):
+        if self.metrics_port:
+            serve_metrics(self.metrics, self.metrics_port)
+
+        # Expire silent peers even when nobody asks, so subscribers hear about it
+        threading.Thread(target = self.reaper, daemon = True).start()
+
         self.listener()
+
+    def reaper(self):
+        while True:
+            time.sleep(min(self.peer_registry.ttl / 4, 1))
+            self.expire()
+
+    def expire(self):
+        for peer in self.peer_registry.expire():
+            logging.info(f"Expired peer server {peer}")
+            self.metrics.inc("registry_events_total", event = "expire")
     
     def listener(self):
         self.tracker_proto = TrackerProtocol()
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind(('', self.tracker_port))
-        sock.listen(1)
+        sock.listen(self.backlog)
 
+        # Subscriptions hold their connection open, so every connection gets its own thread
         while True:
             io, addr = sock.accept()
+            threading.Thread(target = self.handler, args = (io, addr), daemon = True).start()
+
+    def handler(self, io, addr):
+        try:
             logging.info(f"Received connection from {addr}")
 
             # Validate handshake
-            data = io.recv(1024)
+            data = recv_exact(io, 2)
             out = self.tracker_proto.validate_handshake(data)
 
             if not out:
                 logging.error("Invalid handshake!")
-                exit(1)
+                return
             
             if out == "client":
                 self.client_handler(io)
@@ -38,6 +82,11 @@ class Tracker:
                 self.server_handler(io, addr)
             
             io.shutdown(socket.SHUT_RDWR)
+
+        except OSError as e:
+            logging.info(f"Connection from {addr} closed: {e}")
+
+        finally:
             io.close()
     
     def client_handler(self, sock):
@@ -45,17 +94,72 @@ class Tracker:
         handshake = self.tracker_proto.gen_handshake()
         sock.send(handshake.encode())
         
-        # Validate peer request
-        data = sock.recv(1024)
+        # Validate peer request, each is read exactly so one arriving right behind another is not lost
+        data = recv_exact(sock, 2)
         out = self.tracker_proto.validate_peer_req(data)
 
         if not out:
             logging.error("Invalid request!")
-            exit(1)
-        
-        # Send available peers
-        servers = self.tracker_proto.gen_peers(self.peer_servers)
-        sock.send(servers.encode())
+            return
+
+        if out == "subscribe":
+            data += recv_exact(sock, SUBSCRIBE_VERSION.size)
+            self.metrics.inc("subscribers")
+            try:
+                self.subscription_handler(sock, self.tracker_proto.get_subscribe_version(data))
+            finally:
+                self.metrics.inc("subscribers", -1)
+            return
+
+        # Answer queries until the client closes, so it can page through the list on one connection
+        while out == "query":
+            data += recv_exact(sock, PEER_QUERY.size)
+            query = self.tracker_proto.get_peer_query(data)
+            if not query:
+                logging.error("Invalid peer query!")
+                return
+
+            mode, offset, count = query
+            start = time.monotonic()
+            peers = self.peer_registry.select(min(count or PEER_PAGE, PEER_PAGE), mode, offset)
+            servers = self.tracker_proto.gen_peer_list(len(self.peer_registry), peers)
+            self.metrics.inc("lookups_total", mode = mode)
+            self.metrics.observe("lookup_seconds", time.monotonic() - start)
+            sock.sendall(servers)
+
+            data = recv_exact(sock, 2)
+            out = data and self.tracker_proto.validate_peer_req(data)
+
+        if out == "fetch":
+            # Send available peers in the legacy format, least loaded first, once per host as it has no ports
+            start = time.monotonic()
+            servers = self.tracker_proto.gen_peers(list(dict.fromkeys(ip for ip, _ in self.peer_registry.select())))
+            self.metrics.inc("lookups_total", mode = "fetch")
+            self.metrics.observe("lookup_seconds", time.monotonic() - start)
+            sock.send(servers.encode())
+
+    def subscription_handler(self, sock, version):
+        # Stream peer changes until the subscriber goes away, resuming from its version if the log still has it
+        version, events = self.peer_registry.changes(version or 0)
+        while True:
+            if events is None:
+                version, peers = self.peer_registry.snapshot()
+                messages = [self.tracker_proto.gen_peer_event(EVENT_RESET, version)]
+                messages += [
+                    self.tracker_proto.gen_peer_event(EVENT_ADD, version, ip, port)
+                    for ip, port in peers
+                ]
+            else:
+                messages = [
+                    self.tracker_proto.gen_peer_event(EVENT_ADD if op == "add" else EVENT_REMOVE, event_version, ip, port)
+                    for event_version, op, (ip, port) in events
+                ]
+
+            # Sync marks the end of a batch of changes, and doubles as the keepalive
+            messages.append(self.tracker_proto.gen_peer_event(EVENT_SYNC, version))
+            sock.sendall(b"".join(messages))
+
+            version, events = self.peer_registry.changes(version, SUBSCRIPTION_KEEPALIVE)
     
     def server_handler(self, sock, addr):
         # Send handshake
@@ -63,25 +167,41 @@ class Tracker:
         sock.send(handshake.encode())
 
         # Handle server request (add/remove)
-        data = sock.recv(1024)
+        data = recv_exact(sock, 2)
         out = self.tracker_proto.handle_server_req(data)
 
         if not out:
             logging.error("Invalid request!")
-            exit(1)
-        
-        if out == "add":
-            if addr[0] not in self.peer_servers:
-                # Add peer server
-                self.peer_servers.append(addr[0])
-                logging.info(f"Added peer server {addr[0]}")
-        
+            return
+
+        # Add and heartbeat requests may carry a load report and the port the peer serves on, remove requests
+        # the port alone. Peers close their side after a request, so one without a body reads nothing more.
+        # Peers are told apart by IP and port, so several can share a host.
+        load, port = None, 0
+        if out == "remove":
+            data += recv_exact(sock, PEER_PORT.size)
+            port = self.tracker_proto.get_peer_port(data) or 0
         else:
-            try:
-                # Remove peer server
-                self.peer_servers.remove(addr[0])
-            except:
-                pass
+            data += recv_exact(sock, PEER_LOAD.size)
+            report = self.tracker_proto.get_peer_load(data)
+            if report:
+                load, port = report[:3], report[3]
+
+        peer = (addr[0], port)
+        if out == "remove":
+            # Remove peer server
+            if self.peer_registry.remove(peer):
+                logging.info(f"Removed peer server {peer}")
+                self.metrics.inc("registry_events_total", event = "remove")
+
+        else:
+            # Add peer server or refresh its TTL
+            self.metrics.inc("heartbeats_total")
+            if self.peer_registry.heartbeat(peer, load):
+                logging.info(f"Added peer server {peer}")
+                self.metrics.inc("registry_events_total", event = "add")
+
+        self.expire()
 
 
 if __name__ == "__main__":
@@ -103,13 +223,25 @@ if __name__ == "__main__":
                 if line.split(" ")[0] == "TRACKER_PORT":
                     configuration['tracker_port'] = line.split(" ")[-1].strip("\n")
 
+                elif line.split(" ")[0] == "PEER_TTL":
+                    configuration['peer_ttl'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "TRACKER_BACKLOG":
+                    configuration['backlog'] = line.split(" ")[-1].strip("\n")
+
+                elif line.split(" ")[0] == "TRACKER_METRICS_PORT":
+                    configuration['metrics_port'] = line.split(" ")[-1].strip("\n")
+
     except:
         logging.error("Invalid config file!")
         exit(1)
 
     try:
         t = Tracker(
-            tracker_port = configuration['tracker_port']
+            tracker_port = configuration['tracker_port'],
+            peer_ttl = configuration.get('peer_ttl', 30),
+            backlog = configuration.get('backlog', 64),
+            metrics_port = configuration.get('metrics_port', 0)
         )
         t.run()
 
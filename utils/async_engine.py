@@ -0,0 +1,299 @@
+import socket
+import asyncio
+import logging
+from utils.packet_utils import ClientProtocol, FRAME_HEADER, FRAME_DATA, FRAME_ERROR, FLAG_CRC32, FLAG_ZLIB, CHECKSUM, MAX_FRAME_PAYLOAD, PEER_LIST, PEER_PORT, PEER_ADDR_SIZE, parse_frame_header, verify_checksum
+from utils.compression import decompress_frame
+from utils.peer_session import PeerSession
+
+# Read buffer of each peer connection, enough for a couple of full data frames
+STREAM_LIMIT = 2 * MAX_FRAME_PAYLOAD
+
+class AsyncEngine:
+    # Runs a one-shot or batch download of a Client on one event loop. Tracker discovery and all
+    # peer transfers are coroutines, and at most max_inflight ranges are in flight across all peers.
+    # The HEAD requests, the origin fetch and closing finished files stay blocking, in threads.
+    def __init__(self, client):
+        self.client = client
+        self.client_proto = ClientProtocol()
+        self.inflight = 0
+        self.streams = set()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+
+        # Get peer servers
+        await self.get_peer_servers()
+
+        # Get download info, ranges and resume state of every file
+        await asyncio.to_thread(self.client.prepare_jobs)
+
+        # Download into output files
+        await self.download()
+
+    async def get_peer_servers(self):
+        client = self.client
+
+        # Connect to tracker from our fixed port
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', client.client_server_port))
+        sock.setblocking(False)
+        await self.loop.sock_connect(sock, (client.tracker_ip, client.tracker_port))
+        reader, writer = await asyncio.open_connection(sock = sock)
+
+        logging.info(f"Connected to tracker at {client.tracker_ip}:{client.tracker_port}")
+
+        try:
+            # Send handshake to tracking server
+            writer.write(self.client_proto.gen_handshake().encode())
+
+            # Validate received handshake
+            if not self.client_proto.validate_handshake(await reader.readexactly(2)):
+                logging.error("Invalid handshake! Exiting!")
+                exit(1)
+            else:
+                logging.info("Validated handshake!")
+
+            # Get peer servers, only peer_count of them picked by the tracker if set, otherwise page through all of them
+            if client.peer_count:
+                peers = (await self.query_peers(reader, writer, client.peer_selection, 0, client.peer_count))[1]
+            else:
+                peers = []
+                while True:
+                    total, page = await self.query_peers(reader, writer, "page", len(peers))
+                    peers += page
+                    if not page or len(peers) >= total:
+                        break
+
+            client.set_peer_servers(peers)
+
+            # Wait for the tracker to close first, so a restart can rebind our fixed port right away
+            writer.write_eof()
+            await reader.read()
+
+        finally:
+            writer.close()
+
+    async def query_peers(self, reader, writer, mode, offset = 0, count = 0):
+        # Returns (peers known to the tracker, [(IP, port)]) of one peer query
+        writer.write(self.client_proto.gen_query(mode, offset, count))
+        await writer.drain()
+
+        out = self.client_proto.parse_peer_list(await reader.readexactly(PEER_LIST.size))
+        if not out:
+            raise ConnectionError("Invalid peer list!")
+
+        total, count = out
+        peers = []
+        for _ in range(count):
+            family = await reader.readexactly(1)
+            peer = self.client_proto.parse_peer(family + await reader.readexactly(PEER_ADDR_SIZE.get(family[0], 0) + PEER_PORT.size))
+            if not peer:
+                raise ConnectionError("Invalid peer list!")
+            peers.append(peer)
+
+        return (total, peers)
+
+    async def download(self):
+        client = self.client
+
+        # One scheduler for the chunks of every file, it wakes the loop whenever chunks settle or come back
+        scheduler = client.new_scheduler()
+        scheduler.watch(lambda: self.loop.call_soon_threadsafe(self.changed.set))
+
+        for job in client.jobs:
+            if job.state == "queued":
+                client.start_job(scheduler, job)
+
+        # One task per peer server, the origin is fetched with the pooled requests session in a thread
+        peers = [asyncio.create_task(self.server_worker(peer, scheduler)) for peer in client.peer_servers]
+        local = asyncio.create_task(asyncio.to_thread(client.client_worker, scheduler))
+
+        # Once every chunk is settled, cut off peers still busy with a losing hedge. Their tasks are
+        # not cancelled, a cancelled task would leave a chunk it is settling in a thread unfinished.
+        while not all(task.done() for task in peers + [local]):
+            if await self.wait_finished(scheduler, 0.5):
+                break
+
+        for writer in list(self.streams):
+            writer.close()
+
+        await asyncio.gather(*peers, return_exceptions = True)
+        await local
+
+        client.finish_download()
+
+    async def wait_changed(self, timeout):
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def wait_finished(self, scheduler, timeout):
+        # Sleep up to timeout seconds, waking early once every chunk is settled
+        deadline = self.loop.time() + timeout
+        while True:
+            self.changed.clear()
+            if scheduler.wait_finished(0):
+                return True
+
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return False
+
+            await self.wait_changed(remaining)
+
+    async def next_chunk(self, scheduler, worker, steal, wait):
+        # Like ChunkScheduler.next_chunk, but waits on the loop and only takes a chunk while a range slot is free
+        while True:
+            self.changed.clear()
+            if self.inflight < self.client.max_inflight:
+                chunk = scheduler.poll(worker, steal, wait)
+                if chunk:
+                    self.inflight += 1
+                    return chunk
+
+                if chunk is None:
+                    return None
+
+            elif not wait:
+                return None
+
+            # In-flight chunks may still fail and come back, or free a slot
+            await self.wait_changed(0.5)
+
+    def release(self, count = 1):
+        self.inflight -= count
+        self.changed.set()
+
+    async def server_worker(self, peer, scheduler):
+        client = self.client
+
+        # Reconnect after failures, giving up on the peer after max_retries in a row
+        failures = 0
+        while failures <= client.max_retries:
+            completed = await self.peer_session(peer, scheduler)
+            if completed is None:
+                return
+
+            failures = 0 if completed else failures + 1
+            if await self.wait_finished(scheduler, min(2 ** failures, 10)):
+                return
+
+        logging.error(f"Giving up on peer server {peer}!")
+
+    async def peer_session(self, peer, scheduler):
+        # Returns None once there is nothing left, or the number of chunks completed before the connection failed
+        client = self.client
+        session = PeerSession(client, peer, scheduler)
+        writer = None
+
+        try:
+            reader, writer = await self.connect_peer(peer)
+
+            while True:
+                # Keep the pipeline full, only stealing or hedging other peers' chunks when idle
+                while len(session.inflight) < client.pipeline_depth:
+                    chunk = await self.next_chunk(scheduler, peer, steal = not session.inflight, wait = not session.inflight)
+                    if chunk is None:
+                        break
+
+                    request_id = session.add(chunk)
+
+                    # The peer may have closed the connection while it sat idle
+                    if len(session.inflight) == 1 and reader.at_eof():
+                        self.disconnect_peer(writer)
+                        reader, writer = await self.connect_peer(peer)
+
+                    writer.write(session.request(request_id))
+
+                await writer.drain()
+
+                if not session.inflight:
+                    return None
+
+                header = session.check_header(parse_frame_header(await self.read(reader, FRAME_HEADER.size)))
+                type, flags, request_id, offset, length, payload_len = header
+
+                payload = None
+                if type == FRAME_DATA:
+                    payload = await self.receive_frame_payload(reader, payload_len, flags, length)
+                elif type == FRAME_ERROR:
+                    payload = await self.read(reader, payload_len)
+
+                # Writing, hashing and settling chunks block, so they run on a worker thread while other peers are read
+                if await asyncio.to_thread(session.handle_frame, header, payload):
+                    self.release()
+
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            logging.error(f"Connection to peer server {peer} failed: {e}")
+            await asyncio.to_thread(session.hand_back)
+            return session.completed
+
+        finally:
+            session.close()
+            self.release(len(session.inflight))
+            if writer:
+                self.disconnect_peer(writer)
+
+    async def connect_peer(self, peer):
+        # A peer that sends nothing for progress_timeout seconds counts as failed
+        client = self.client
+        ip, port = client.peer_address(peer)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port, limit = STREAM_LIMIT), client.progress_timeout)
+
+        if client.compression and peer not in client.plain_peers and not await self.negotiate(reader, writer, peer):
+            # Peers that predate negotiation drop the connection, talk to them uncompressed from now on
+            writer.close()
+            client.plain_peers.add(peer)
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port, limit = STREAM_LIMIT), client.progress_timeout)
+
+        self.streams.add(writer)
+        logging.info(f"Connected to peer server {peer}")
+        return reader, writer
+
+    def disconnect_peer(self, writer):
+        self.streams.discard(writer)
+        writer.close()
+
+    async def negotiate(self, reader, writer, peer):
+        # Offer our codec, returns False if the peer does not understand the offer
+        writer.write(self.client_proto.gen_hello([self.client.compression]))
+
+        try:
+            header = parse_frame_header(await self.read(reader, FRAME_HEADER.size))
+            codec = header and self.client_proto.get_hello(header, await self.read(reader, header[5]))
+        except asyncio.IncompleteReadError:
+            return False
+
+        if codec is False:
+            return False
+
+        logging.info(f"Compression with peer server {peer}: {codec or 'none'}")
+        return True
+
+    async def read(self, reader, size):
+        return await asyncio.wait_for(reader.readexactly(size), self.client.progress_timeout)
+
+    async def receive_frame_payload(self, reader, size, flags, length):
+        # Returns the payload, decompressed, or None if it is corrupt or its checksum does not match
+        if size > MAX_FRAME_PAYLOAD or length > MAX_FRAME_PAYLOAD:
+            raise ConnectionError(f"Frame of {max(size, length)} bytes exceeds {MAX_FRAME_PAYLOAD}!")
+
+        data = await self.read(reader, size)
+        trailer = await self.read(reader, CHECKSUM.size) if flags & FLAG_CRC32 else None
+
+        # Decompressing and checksumming a whole frame would stall every other peer on the loop
+        return await asyncio.to_thread(decode_payload, data, trailer, flags, length)
+
+def decode_payload(data, trailer, flags, length):
+    if flags & FLAG_ZLIB:
+        data = decompress_frame(data, length)
+        if data is None:
+            return None
+
+    if trailer is not None and not verify_checksum(data, trailer):
+        return None
+
+    return data
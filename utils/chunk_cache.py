@@ -0,0 +1,121 @@
+import os
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Data is checksummed in blocks of this size, so aligned blocks can be sent without reading them
+CACHE_BLOCK = 256 * 1024
+
+class CacheEntry:
+    def __init__(self, size, crcs, data = None, path = None):
+        self.size = size
+        self.crcs = crcs
+        self.data = data
+        self.path = path
+
+class ChunkCache:
+    # Size-bounded LRU of chunk-aligned upstream data keyed by URL, validator and chunk offset.
+    # Recently used chunks stay in memory; chunks evicted from memory spill to files under
+    # cache_dir, which are evicted in turn once the disk budget is used up.
+    def __init__(self, memory_bytes, disk_bytes, cache_dir):
+        self.memory_bytes = int(memory_bytes)
+        self.disk_bytes = int(disk_bytes)
+        self.cache_dir = str(cache_dir)
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.memory_used = 0
+        self.disk_used = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.spilled = 0
+        self.lock = threading.Lock()
+
+        if self.disk_bytes:
+            # Spilled chunks from an earlier run are not indexed, start clean
+            os.makedirs(self.cache_dir, exist_ok = True)
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".chunk"):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def get(self, key):
+        # Returns (entry, file) where file is an open handle for disk hits, or None on a miss
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return (entry, None)
+
+            entry = self.disk.get(key)
+            if entry:
+                self.disk.move_to_end(key)
+                self.hits += 1
+                self.disk_hits += 1
+                # Opened under the lock, so a later eviction cannot unlink it first
+                return (entry, open(entry.path, "rb"))
+
+            self.misses += 1
+            return None
+
+    def put(self, key, data):
+        # Returns the in-memory entry for the data, whether or not it was kept
+        crcs = [zlib.crc32(data[i:(i + CACHE_BLOCK)]) for i in range(0, len(data), CACHE_BLOCK)]
+        entry = CacheEntry(len(data), crcs, data = bytes(data))
+
+        with self.lock:
+            if key in self.memory or key in self.disk or entry.size > max(self.memory_bytes, self.disk_bytes):
+                return entry
+
+            spills = []
+            if self.memory_bytes:
+                self.memory[key] = entry
+                self.memory_used += entry.size
+            else:
+                spills.append((key, entry))
+
+            while self.memory_used > self.memory_bytes:
+                old_key, old_entry = self.memory.popitem(last = False)
+                self.memory_used -= old_entry.size
+                spills.append((old_key, old_entry))
+
+            # Each spill gets a file of its own, a key can be put again while its file is being written
+            spills = [(old_key, old_entry, self.spill_path(old_key)) for old_key, old_entry in spills if old_entry.size <= self.disk_bytes]
+
+        # Written without the lock, a chunk being spilled is a miss until it is on disk
+        for old_key, old_entry, path in spills:
+            self.spill(old_key, old_entry, path)
+
+        return entry
+
+    def spill_path(self, key):
+        self.spilled += 1
+        return os.path.join(self.cache_dir, f"{hashlib.sha1(repr(key).encode()).hexdigest()}-{self.spilled}.chunk")
+
+    def spill(self, key, entry, path):
+        with open(path, "wb") as f:
+            f.write(entry.data)
+
+        with self.lock:
+            if key in self.memory or key in self.disk:
+                os.remove(path)
+                return
+
+            self.disk[key] = CacheEntry(entry.size, entry.crcs, path = path)
+            self.disk_used += entry.size
+
+            while self.disk_used > self.disk_bytes:
+                old_key, old_entry = self.disk.popitem(last = False)
+                self.disk_used -= old_entry.size
+                os.remove(old_entry.path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_bytes': self.memory_used,
+                'disk_bytes': self.disk_used
+            }
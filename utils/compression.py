@@ -0,0 +1,61 @@
+import zlib
+
+# Codecs peers can negotiate for data frames
+CODECS = ("zlib",)
+
+# A frame is only sent compressed if that saves at least this fraction of it
+MIN_SAVING = 0.1
+
+# Bytes compressed to judge whether a frame is worth compressing
+SAMPLE_SIZE = 16 * 1024
+
+# Frames sent raw between samples, once a range turned out incompressible
+SAMPLE_EVERY = 16
+
+class FrameCompressor:
+    # Compresses the data frames of one connection while they keep shrinking. Content that does
+    # not compress is sent raw, and only a small sample is tried again every SAMPLE_EVERY frames.
+    def __init__(self, level = 1):
+        self.level = level
+        self.reset()
+
+    def reset(self):
+        # A new range may compress differently
+        self.compressible = None
+        self.skipped = 0
+
+    def next_frame(self):
+        # Returns the compressor if the next frame should be tried, or None to send it raw
+        if self.compressible is not False:
+            return self
+
+        self.skipped += 1
+        if self.skipped < SAMPLE_EVERY:
+            return None
+
+        self.skipped = 0
+        return self
+
+    def compress(self, view):
+        # Returns the compressed frame, or None if it does not shrink enough
+        if not self.compressible:
+            sample = view[:SAMPLE_SIZE]
+            if len(zlib.compress(sample, self.level)) > len(sample) * (1 - MIN_SAVING):
+                self.compressible = False
+                return None
+
+        data = zlib.compress(view, self.level)
+        self.compressible = len(data) <= len(view) * (1 - MIN_SAVING)
+        return data if self.compressible else None
+
+def decompress_frame(payload, length):
+    # Returns the decompressed frame, or None if it is corrupt or not length bytes long
+    try:
+        d = zlib.decompressobj()
+        data = d.decompress(payload, length)
+        if len(data) != length or not d.eof or d.unconsumed_tail:
+            return None
+        return data
+
+    except zlib.error:
+        return None
@@ -0,0 +1,82 @@
+import os
+import heapq
+import hashlib
+import threading
+
+# Size of reads when hashing data that landed ahead of the in-order frontier
+READ_SIZE = 1024 * 1024
+
+class FileDigest:
+    # SHA-256 of a file assembled out of order. Bytes landing at the in-order frontier
+    # are hashed straight from the receive buffer; bytes landing ahead of it are hashed
+    # from the file (usually still in page cache) once the frontier catches up.
+    # One thread at a time hashes, outside the lock, so others landing data never wait on it.
+    def __init__(self, fd, size):
+        self.fd = fd
+        self.size = size
+        self.sha = hashlib.sha256()
+        self.frontier = 0
+        self.ahead = []
+        self.hashing = False
+        self.cond = threading.Condition()
+
+    def update(self, offset, data):
+        end = offset + len(data)
+        with self.cond:
+            if self.hashing or offset > self.frontier:
+                # Read back from the file once the frontier gets here
+                heapq.heappush(self.ahead, (offset, end))
+                return
+            if end <= self.frontier:
+                return
+            self.hashing = True
+            start = self.frontier
+
+        self.sha.update(memoryview(data)[(start - offset):])
+        with self.cond:
+            self.frontier = end
+        self.catch_up()
+
+    def add_existing(self, start, end):
+        # Data already on disk, e.g. chunks completed by a previous run
+        with self.cond:
+            heapq.heappush(self.ahead, (start, end + 1))
+            if self.hashing:
+                return
+            self.hashing = True
+        self.catch_up()
+
+    def catch_up(self):
+        # Called by the hashing thread, hashes whatever reaches the frontier until nothing does
+        while True:
+            with self.cond:
+                start = end = self.frontier
+                while self.ahead and self.ahead[0][0] <= end:
+                    end = max(end, heapq.heappop(self.ahead)[1])
+
+                if end == start:
+                    self.hashing = False
+                    self.cond.notify_all()
+                    return
+
+            reached = self.hash_file(start, end)
+            with self.cond:
+                self.frontier = reached
+
+    def hash_file(self, start, end):
+        # Returns where hashing stopped
+        while start < end:
+            data = os.pread(self.fd, min(READ_SIZE, end - start), start)
+            if not data:
+                break
+            self.sha.update(data)
+            start += len(data)
+        return start
+
+    def hexdigest(self):
+        with self.cond:
+            self.cond.wait_for(lambda: not self.hashing)
+            if self.frontier < self.size:
+                # Should not happen once every chunk is done, but never report a partial hash
+                self.frontier = self.hash_file(self.frontier, self.size)
+            return self.sha.hexdigest()
@@ -0,0 +1,157 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds of traffic a client may send at once after being idle
+BURST_SECONDS = 0.1
+
+class TokenBucket:
+    # Byte rate limit, a rate of 0 is unlimited. Sends may overdraw the bucket, the
+    # sender then sleeps until the debt is paid, so concurrent senders are served in turn.
+    def __init__(self, rate = 0):
+        self.rate = float(rate)
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, size):
+        # Returns the seconds slept
+        if not self.rate:
+            return 0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.stamp) * self.rate, self.rate * BURST_SECONDS) - size
+            self.stamp = now
+            wait = -self.tokens / self.rate
+
+        if wait <= 0:
+            return 0
+
+        time.sleep(wait)
+        return wait
+
+class ThrottledSocket:
+    # Socket whose sends are paced by the client's share of the egress limits.
+    # on_send(size, throttled, sending) is told how long each send waited for tokens and for the socket.
+    def __init__(self, sock, share, client, on_send = None):
+        self.sock = sock
+        self.share = share
+        self.client = client
+        self.on_send = on_send
+
+    def sendall(self, data):
+        throttled = self.share.throttle(self.client, len(data))
+        start = time.monotonic()
+        self.sock.sendall(data)
+        if self.on_send:
+            self.on_send(len(data), throttled, time.monotonic() - start)
+
+    def sendfile(self, f, offset, count):
+        throttled = self.share.throttle(self.client, count)
+        start = time.monotonic()
+        sent = self.sock.sendfile(f, offset, count)
+        if self.on_send:
+            self.on_send(sent, throttled, time.monotonic() - start)
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class FairShare:
+    # Shares the range slots and egress of a peer server between its clients.
+    # Ranges waiting for a slot are granted in weighted fair queuing order: each range is
+    # tagged with its client's virtual finish time, its size over the client's weight added
+    # to where the client left off, so a client with a few small ranges overtakes one with
+    # a deep queue of large ones. Every send is paced by the client's own bucket at client_rate
+    # and then by one bucket at total_rate shared by all, so whatever a client leaves unused,
+    # waiting on upstream or on a slow reader, goes to the others.
+    def __init__(self, slots, total_rate = 0, client_rate = 0, weights = None):
+        self.slots = int(slots)
+        self.total = TokenBucket(total_rate)
+        self.client_rate = float(client_rate)
+        self.weights = {client: float(weight) for client, weight in (weights or {}).items()}
+        for client, weight in self.weights.items():
+            if weight <= 0:
+                raise ValueError(f"Weight of client {client} must be positive!")
+        self.virtual = 0.0
+        self.finish = {}
+        self.waiting = []
+        self.granted = set()
+        self.serving = {}
+        self.buckets = {}
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+
+    def weight(self, client):
+        return self.weights.get(client, 1.0)
+
+    def acquire(self, client, size):
+        # Block until the range gets a slot
+        with self.cond:
+            start = max(self.virtual, self.finish.get(client, 0.0))
+            self.finish[client] = start + max(size, 1) / self.weight(client)
+
+            ticket = next(self.sequence)
+            heapq.heappush(self.waiting, (self.finish[client], ticket, start, client))
+            self.grant()
+            self.cond.wait_for(lambda: ticket in self.granted)
+            self.granted.discard(ticket)
+
+    def release(self, client):
+        with self.cond:
+            self.slots += 1
+            self.serving[client] -= 1
+            if not self.serving[client]:
+                del self.serving[client]
+                self.buckets.pop(client, None)
+
+            # Clients that caught up with the virtual time carry nothing over, nor does anyone once all is served
+            if not self.serving and not self.waiting:
+                self.virtual = 0.0
+                self.finish = {}
+            else:
+                self.finish = {c: tag for c, tag in self.finish.items() if tag > self.virtual or c in self.serving}
+            self.grant()
+
+    def grant(self):
+        while self.slots and self.waiting:
+            tag, ticket, start, client = heapq.heappop(self.waiting)
+            self.virtual = max(self.virtual, start)
+            self.slots -= 1
+            self.serving[client] = self.serving.get(client, 0) + 1
+            self.granted.add(ticket)
+
+        self.cond.notify_all()
+
+    @contextmanager
+    def slot(self, client, size):
+        self.acquire(client, size)
+        try:
+            yield
+        finally:
+            self.release(client)
+
+    def throttle(self, client, size):
+        # Returns the seconds slept. Only range data is paced, handshakes go out right away.
+        if not self.total.rate and not self.client_rate:
+            return 0
+
+        with self.cond:
+            if client not in self.serving:
+                return 0
+            bucket = self.buckets.setdefault(client, TokenBucket(self.client_rate))
+        return bucket.take(size) + self.total.take(size)
+
+    def connect(self, sock, client, on_send = None):
+        return ThrottledSocket(sock, self, client, on_send)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'serving': dict(self.serving),
+                'waiting': len(self.waiting),
+                'free_slots': self.slots
+            }
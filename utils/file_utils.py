@@ -0,0 +1,15 @@
+import os
+
+def preallocate(path, size):
+    # Create (sparse) output file at its final size
+    fd = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o644)
+    os.ftruncate(fd, size)
+    return fd
+
+def write_at(fd, data, offset):
+    # pwrite may write less than asked, loop until the block is on disk
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
@@ -0,0 +1,10 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+def make_session(pool_size):
+    # Keep-alive session with a connection pool per origin, shared by all threads
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = int(pool_size), pool_maxsize = int(pool_size))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
@@ -0,0 +1,42 @@
+import json
+import socket
+
+# Default path of the client daemon's job socket
+DAEMON_SOCKET = ".peer_client.sock"
+
+def parse_batch_line(line):
+    # Batch file lines are "<url> <path> [sha256] [mirror ...]", returns None for blank lines and comments
+    fields = line.split()
+    if not fields or fields[0].startswith("#"):
+        return None
+
+    extra = fields[2:]
+    return {
+        'url': fields[0],
+        'path': fields[1],
+        'sha256': next((field for field in extra if "://" not in field), None),
+        'mirrors': [field for field in extra if "://" in field]
+    }
+
+def send_message(sock, message):
+    # Messages are single lines of JSON
+    sock.sendall(json.dumps(message).encode() + b"\n")
+
+def recv_message(sock):
+    with sock.makefile("rb") as f:
+        line = f.readline()
+
+    if not line:
+        raise ConnectionError("Connection closed!")
+
+    return json.loads(line)
+
+def request(socket_path, message):
+    # One request and its reply over a fresh connection to the daemon
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(socket_path))
+        send_message(sock, message)
+        return recv_message(sock)
+    finally:
+        sock.close()
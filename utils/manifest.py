@@ -0,0 +1,56 @@
+import os
+import json
+import threading
+
+class Manifest:
+    # Sidecar file next to the output, recording the job plan and a bitmap of completed chunks
+    def __init__(self, path, url, validator, ranges, done = None):
+        self.path = str(path)
+        self.url = url
+        self.validator = validator
+        self.ranges = [tuple(r) for r in ranges]
+        self.done = bytearray(done) if done is not None else bytearray((len(self.ranges) + 7) // 8)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(str(path), "r") as f:
+                data = json.load(f)
+            return cls(path, data['url'], data['validator'], data['ranges'], bytes.fromhex(data['done']))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def matches(self, url, validator):
+        return self.url == url and self.validator == validator and len(self.done) == (len(self.ranges) + 7) // 8
+
+    def mark(self, i):
+        with self.lock:
+            self.done[i // 8] |= 1 << (i % 8)
+
+    def is_done(self, i):
+        return bool(self.done[i // 8] & (1 << (i % 8)))
+
+    def missing(self):
+        return [i for i in range(len(self.ranges)) if not self.is_done(i)]
+
+    def save(self):
+        with self.lock:
+            data = {
+                'url': self.url,
+                'validator': self.validator,
+                'ranges': self.ranges,
+                'done': self.done.hex()
+            }
+
+        # Write atomically so a crash never leaves a truncated manifest
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
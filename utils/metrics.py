@@ -0,0 +1,138 @@
+import json
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    # Counters, gauges and histograms of one component, rendered in the Prometheus text format.
+    # Gauges may instead be collected when scraped, from a function returning a value or a
+    # dict of values by the value of one label.
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.kinds = {}
+        self.values = {}
+        self.collectors = {}
+        self.lock = threading.Lock()
+
+    def define(self, kind, name, help, buckets = None, collect = None, label = None):
+        self.kinds[name] = (kind, help, buckets)
+        self.values[name] = {}
+        if collect:
+            self.collectors[name] = (collect, label)
+
+    def counter(self, name, help):
+        self.define("counter", name, help)
+
+    def gauge(self, name, help, collect = None, label = None):
+        self.define("gauge", name, help, collect = collect, label = label)
+
+    def histogram(self, name, help, buckets = LATENCY_BUCKETS):
+        self.define("histogram", name, help, buckets = buckets)
+
+    def inc(self, name, value = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.kinds[name][2]
+        with self.lock:
+            counts, total = self.values[name].get(key, ([0] * (len(buckets) + 1), 0.0))
+            counts[bisect.bisect_left(buckets, value)] += 1
+            self.values[name][key] = (counts, total + value)
+
+    def collect(self, name):
+        collect, label = self.collectors[name]
+        try:
+            value = collect()
+        except Exception as e:
+            logging.error(f"Could not collect {name}: {e}")
+            return {}
+
+        if isinstance(value, dict):
+            return {((label, str(k)),): v for k, v in value.items()}
+        return {(): value}
+
+    def render(self):
+        lines = []
+        for name, (kind, help, buckets) in self.kinds.items():
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full} {help}")
+            lines.append(f"# TYPE {full} {kind}")
+
+            if name in self.collectors:
+                values = self.collect(name)
+            else:
+                with self.lock:
+                    values = {key: (list(value[0]), value[1]) if kind == "histogram" else value for key, value in self.values[name].items()}
+
+            for key, value in values.items():
+                if kind != "histogram":
+                    lines.append(f"{full}{format_labels(key)} {value}")
+                    continue
+
+                # Histogram buckets are cumulative
+                counts, total = value
+                seen = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], counts):
+                    seen += count
+                    lines.append(f"{full}_bucket{format_labels(key + (('le', str(bound)),))} {seen}")
+                lines.append(f"{full}_sum{format_labels(key)} {total}")
+                lines.append(f"{full}_count{format_labels(key)} {seen}")
+
+        return "\n".join(lines) + "\n"
+
+def format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f"{name}=\"{escape_label(value)}\"" for name, value in key) + "}"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def serve_metrics(metrics, port):
+    # Serve /metrics on localhost from a background thread
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", int(port)), Handler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    logging.info(f"Serving metrics on port {port}")
+    return server
+
+class TraceLog:
+    # Structured trace, one JSON object per line, written as events happen
+    def __init__(self, path):
+        self.file = open(path, "a", buffering = 1)
+        self.lock = threading.Lock()
+
+    def write(self, event, **fields):
+        # Fields that are None are left out, times are rounded to microseconds
+        fields = {k: round(v, 6) if isinstance(v, float) else v for k, v in fields.items() if v is not None}
+        line = json.dumps({'ts': round(time.time(), 6), 'event': event, **fields})
+        with self.lock:
+            self.file.write(line + "\n")
@@ -0,0 +1,43 @@
+import threading
+
+# Weight of the newest sample in a mirror's throughput average
+EWMA_WEIGHT = 0.3
+
+# Factor a mirror's throughput is cut by when a request to it fails
+FAILURE_PENALTY = 0.5
+
+class MirrorSet:
+    # Equivalent origin URLs of one file. Each request goes to the mirror with the most expected
+    # throughput per request in flight, mirrors not measured yet are assumed as fast as the best one.
+    def __init__(self, urls):
+        self.urls = list(dict.fromkeys(urls))
+        self.throughput = {}
+        self.inflight = {url: 0 for url in self.urls}
+        self.lock = threading.Lock()
+
+    def drop(self, url):
+        with self.lock:
+            if len(self.urls) > 1 and url in self.urls:
+                self.urls.remove(url)
+
+    def acquire(self):
+        # Returns the URL for the next request, release it once the request is over
+        with self.lock:
+            best = max(self.throughput.values(), default = 1)
+            url = max(self.urls, key = lambda url: self.throughput.get(url, best) / (self.inflight[url] + 1))
+            self.inflight[url] += 1
+            return url
+
+    def release(self, url, size = 0, elapsed = 0, failed = False):
+        with self.lock:
+            self.inflight[url] -= 1
+
+            if failed:
+                self.throughput[url] = self.throughput.get(url, max(self.throughput.values(), default = 1)) * FAILURE_PENALTY
+            elif size and elapsed > 0:
+                rate = size / elapsed
+                old = self.throughput.get(url)
+                self.throughput[url] = rate if old is None else (1 - EWMA_WEIGHT) * old + EWMA_WEIGHT * rate
+
+    def __len__(self):
+        return len(self.urls)
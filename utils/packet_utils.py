@@ -1,5 +1,112 @@
+import zlib
+import socket
+import struct
+import ipaddress
 from utils.byte_utils import *
 
+# Protocol v2 frame header: magic, version, type, flags, request ID, 64-bit offset and length, payload length
+FRAME_MAGIC = b"DM"
+FRAME_VERSION = 2
+FRAME_HEADER = struct.Struct(">2sBBHIQQI")
+
+# Frame types
+FRAME_RANGE = 1 # Range request, payload is the URL
+FRAME_DATA = 2 # Range data at offset, payload is the data
+FRAME_END = 3 # Range complete, length is the number of bytes sent
+FRAME_ERROR = 4 # Range failed, payload is the error message
+FRAME_HELLO = 5 # Optional first frame, payload is the comma separated codecs offered, or the one picked
+
+# Frame flags
+FLAG_CRC32 = 0x1 # Payload is followed by a CRC32 trailer
+FLAG_ZLIB = 0x2 # Payload is zlib compressed, length is its size uncompressed and the CRC32 covers the uncompressed data
+
+CHECKSUM = struct.Struct(">I")
+
+# Largest DATA payload a peer sends in one frame
+MAX_FRAME_PAYLOAD = 1024 * 1024
+
+# Largest payload of any other frame, a URL, codec list or error message
+MAX_CONTROL_PAYLOAD = 64 * 1024
+
+# Peer list subscription: version to resume from, then a stream of events (type, version, port, IP length, IP)
+SUBSCRIBE_VERSION = struct.Struct(">Q")
+PEER_EVENT = struct.Struct(">BQHB")
+
+# Peer event types
+EVENT_RESET = 0 # A full snapshot follows, forget the cached list
+EVENT_ADD = 1 # Peer joined
+EVENT_REMOVE = 2 # Peer left or expired
+EVENT_SYNC = 3 # Caught up with the tracker, also sent as a keepalive
+
+# Load report of a peer server, sent with add and heartbeat requests: ranges in flight or queued, range capacity,
+# throughput in bytes/s and the port it serves clients on
+PEER_LOAD = struct.Struct(">IIQH")
+
+# Peer query: mode, offset into the list, number of peers wanted (0 for as many as fit in one response)
+PEER_QUERY = struct.Struct(">BII")
+
+# Peer query modes
+QUERY_LOAD = 0 # Fewest ranges per range slot first
+QUERY_CAPACITY = 1 # Most free range slots first
+QUERY_PAGE = 2 # Stable order, for paging through the whole list
+QUERY_SAMPLE = 3 # Random sample
+QUERY_MODES = {QUERY_LOAD: "load", QUERY_CAPACITY: "capacity", QUERY_PAGE: "page", QUERY_SAMPLE: "sample"}
+
+# Peer list: peers known to the tracker, peers in this response, then per peer its
+# address family (4 or 6), packed address and port
+PEER_LIST = struct.Struct(">II")
+PEER_PORT = struct.Struct(">H")
+PEER_ADDR_SIZE = {4: 4, 6: 16}
+
+def pack_peer(ip, port = 0):
+    addr = ipaddress.ip_address(ip)
+    return bytes([addr.version]) + addr.packed + PEER_PORT.pack(port)
+
+def unpack_peer(data):
+    # Returns (IP, port) of a packed peer, the first byte is the address family
+    size = PEER_ADDR_SIZE[data[0]]
+    family = socket.AF_INET if data[0] == 4 else socket.AF_INET6
+    return (socket.inet_ntop(family, bytes(data[1:(1 + size)])), PEER_PORT.unpack_from(data, 1 + size)[0])
+
+def peer_name(ip, port = 0):
+    # How a peer server is told apart from others on its host, the port is left out if it never reported one
+    if not port:
+        return ip
+    return f"[{ip}]:{port}" if ":" in ip else f"{ip}:{port}"
+
+def gen_frame(type, request_id, offset = 0, length = 0, payload = b"", flags = 0):
+    return gen_frame_header(type, request_id, offset, length, len(payload), flags) + payload
+
+def gen_frame_header(type, request_id, offset, length, payload_len, flags = 0):
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, type, flags, request_id, offset, length, payload_len)
+
+def gen_checksum(data):
+    return CHECKSUM.pack(zlib.crc32(data))
+
+def verify_checksum(data, trailer):
+    return len(trailer) == CHECKSUM.size and CHECKSUM.unpack(trailer)[0] == zlib.crc32(data)
+
+def is_frame(data):
+    return bytes(data[:len(FRAME_MAGIC)]) == FRAME_MAGIC
+
+def parse_frame_header(data):
+    # Returns (type, flags, request ID, offset, length, payload length), control frames
+    # claiming more than MAX_CONTROL_PAYLOAD are rejected before their payload is read
+    try:
+        magic, version, type, flags, request_id, offset, length, payload_len = FRAME_HEADER.unpack_from(data)
+
+        if (
+            magic == FRAME_MAGIC and \
+            version == FRAME_VERSION and \
+            (type == FRAME_DATA or payload_len <= MAX_CONTROL_PAYLOAD)
+        ):
+            return (type, flags, request_id, offset, length, payload_len)
+
+        return False
+
+    except:
+        return False
+
 class ClientProtocol:
     def gen_handshake(self):
         data = ""
@@ -13,6 +120,20 @@ class ClientProtocol:
         data += "\x01" # Type (Fetch Servers)
         return data
     
+    def gen_subscribe(self, version = 0):
+        data = b""
+        data += b"\x00" # Client ID
+        data += b"\x02" # Type (Subscribe)
+        data += SUBSCRIBE_VERSION.pack(version) # Last version seen, 0 for a full snapshot
+        return data
+
+    def gen_query(self, mode = "page", offset = 0, count = 0):
+        data = b""
+        data += b"\x00" # Client ID
+        data += b"\x03" # Type (Query Servers)
+        data += PEER_QUERY.pack({name: code for code, name in QUERY_MODES.items()}[mode], offset, count)
+        return data
+
     def validate_handshake(self, data):
         try:
             id = data[0]
@@ -28,6 +149,31 @@ class ClientProtocol:
 
         except:
             return False
+
+    def parse_peer_event(self, data):
+        # Returns (type, version, port, IP length)
+        try:
+            type, version, port, ip_len = PEER_EVENT.unpack(data)
+            if type in (EVENT_RESET, EVENT_ADD, EVENT_REMOVE, EVENT_SYNC):
+                return (type, version, port, ip_len)
+            return False
+
+        except:
+            return False
+
+    def parse_peer_list(self, data):
+        # Returns (peers known, peers following) of a peer list header
+        try:
+            return PEER_LIST.unpack(data)
+        except:
+            return False
+
+    def parse_peer(self, data):
+        # Returns (IP, port) of a packed peer
+        try:
+            return unpack_peer(data)
+        except:
+            return False
     
     def parse_ips(self, data):
         ips = []
@@ -55,6 +201,24 @@ class ClientProtocol:
         data += str(range[1])
         return data
     
+    def gen_hello(self, codecs):
+        return gen_frame(FRAME_HELLO, 0, payload = ",".join(codecs).encode())
+
+    def get_hello(self, header, payload):
+        # Returns the codec the peer picked, "" for none
+        try:
+            if header[0] == FRAME_HELLO:
+                return bytes(payload).decode()
+            return False
+
+        except:
+            return False
+
+    def gen_range_request(self, request_id, url, range, validator = ""):
+        # Payload is the URL, optionally followed by a NUL and the validator of the remote file
+        payload = url.encode() + (b"\x00" + validator.encode() if validator else b"")
+        return gen_frame(FRAME_RANGE, request_id, range[0], range[1] - range[0] + 1, payload)
+
     def get_downloaded_data(self, data):
         try:
             id = data[0]
@@ -71,7 +235,7 @@ class ClientProtocol:
 
         except:
             return False
-    
+
 class ServerProtocol:
     def gen_handshake(self):
         data = ""
@@ -79,16 +243,25 @@ class ServerProtocol:
         data += "\x00" # Type (Handshake)
         return data
     
-    def add_peer(self):
-        data = ""
-        data += "\x01" # Server ID
-        data += "\x01" # Type (Add peer)
+    def add_peer(self, load = None):
+        data = b""
+        data += b"\x01" # Server ID
+        data += b"\x01" # Type (Add peer)
+        data += PEER_LOAD.pack(*load) if load else b""
         return data
     
-    def remove_peer(self):
-        data = ""
-        data += "\x01" # Server ID
-        data += "\x02" # Type (Remove peer)
+    def remove_peer(self, port = 0):
+        data = b""
+        data += b"\x01" # Server ID
+        data += b"\x02" # Type (Remove peer)
+        data += PEER_PORT.pack(port) if port else b"" # Port the peer serves on
+        return data
+
+    def heartbeat(self, load = None):
+        data = b""
+        data += b"\x01" # Server ID
+        data += b"\x03" # Type (Heartbeat)
+        data += PEER_LOAD.pack(*load) if load else b""
         return data
     
     def validate_handshake(self, data):
@@ -138,6 +311,55 @@ class ServerProtocol:
         except:
             return False
     
+    def get_range_request(self, header, payload):
+        # Returns [URL, range, request ID, validator] of a v2 range request
+        try:
+            type, flags, request_id, offset, length, payload_len = header
+            url, _, validator = bytes(payload).decode().partition("\x00")
+
+            if (
+                type == FRAME_RANGE and \
+                length > 0
+            ):
+                return [url, (offset, offset + length - 1), request_id, validator]
+
+            return False
+
+        except:
+            return False
+
+    def get_hello(self, header, payload):
+        # Returns the codecs offered by the client
+        try:
+            if header[0] == FRAME_HELLO:
+                return bytes(payload).decode().split(",")
+            return False
+
+        except:
+            return False
+
+    def gen_hello(self, codec = ""):
+        return gen_frame(FRAME_HELLO, 0, payload = codec.encode())
+
+    def gen_data_frame_header(self, request_id, offset, payload_len, flags = FLAG_CRC32, length = None):
+        # length is the size of the data before compression
+        return gen_frame_header(FRAME_DATA, request_id, offset, payload_len if length is None else length, payload_len, flags)
+
+    def gen_checksum(self, data):
+        return gen_checksum(data)
+
+    def gen_end_frame(self, request_id, offset, length):
+        return gen_frame(FRAME_END, request_id, offset, length)
+
+    def gen_error_frame(self, request_id, message):
+        return gen_frame(FRAME_ERROR, request_id, payload = message.encode())
+
+    def gen_data_header(self):
+        data = b""
+        data += b"\x01" # Server ID
+        data += b"\x03" # Type (Download)
+        return data
+
     def gen_data_packet(self, content):
         data = b""
         data += b"\x01" # Server ID
@@ -175,16 +397,55 @@ class TrackerProtocol:
 
             if (
                 id == 0 and \
-                type == 1
+                type in (1, 2, 3)
             ):
-                return True
+                return {1: "fetch", 2: "subscribe", 3: "query"}[type]
 
             return False
 
         except:
             return False
 
+    def get_subscribe_version(self, data):
+        try:
+            return SUBSCRIBE_VERSION.unpack_from(data, 2)[0]
+        except:
+            return False
+
+    def get_peer_query(self, data):
+        # Returns (mode, offset, count) of a peer query
+        try:
+            mode, offset, count = PEER_QUERY.unpack_from(data, 2)
+            return (QUERY_MODES[mode], offset, count)
+        except:
+            return False
+
+    def get_peer_load(self, data):
+        # Returns (in flight, capacity, throughput, port) if the request carries a load report
+        try:
+            return PEER_LOAD.unpack_from(data, 2)
+        except:
+            return None
+
+    def get_peer_port(self, data):
+        # Returns the port a remove request carries, None if it has none
+        try:
+            return PEER_PORT.unpack_from(data, 2)[0]
+        except:
+            return None
+
+    def gen_peer_event(self, type, version, ip = "", port = 0):
+        return PEER_EVENT.pack(type, version, port, len(ip)) + ip.encode()
+
+    def gen_peer_list(self, total, peers):
+        # peers is a list of (IP, port)
+        data = PEER_LIST.pack(total, len(peers))
+        data += b"".join(pack_peer(ip, port) for ip, port in peers)
+        return data
+
     def gen_peers(self, peer_servers):
+        # Legacy list, its count is a single byte
+        peer_servers = peer_servers[:255]
         data = ""
         data += b2s(int2byte((len(peer_servers))))
         for ip in peer_servers:
@@ -199,9 +460,9 @@ class TrackerProtocol:
 
             if (
                 id == 1 and \
-                (type == 1 or type == 2)
+                type in (1, 2, 3)
             ):
-                return "add" if type == 1 else "remove"
+                return {1: "add", 2: "remove", 3: "heartbeat"}[type]
 
             return False
 
@@ -0,0 +1,123 @@
+import time
+import random
+import threading
+from collections import OrderedDict, deque
+
+# Peer changes kept for subscribers that reconnect and ask for what they missed
+EVENT_LOG = 1024
+
+class PeerRegistry:
+    # Peers by (IP, port), ordered by last heartbeat, so expiry only ever looks at the front.
+    # Peers that never reported the port they serve on have port 0.
+    # Every addition and removal bumps the version and is logged for subscribers.
+    def __init__(self, ttl):
+        self.ttl = float(ttl)
+        self.peers = OrderedDict()
+        self.events = deque(maxlen = EVENT_LOG)
+
+        # Last load report of each peer and how often it was handed out since
+        self.loads = {}
+        self.handed = {}
+        self.cond = threading.Condition()
+
+        # Versions keep increasing across tracker restarts, so stale subscribers are never replayed the wrong log
+        self.version = time.time_ns() // 1000
+
+    def log(self, op, addr):
+        self.version += 1
+        self.events.append((self.version, op, addr))
+        self.cond.notify_all()
+
+    def heartbeat(self, addr, load = None):
+        # Add or refresh peer, returns True if it is new
+        with self.cond:
+            new = addr not in self.peers
+            self.peers[addr] = time.monotonic()
+            self.peers.move_to_end(addr)
+            if load:
+                self.loads[addr] = load
+                self.handed.pop(addr, None)
+            if new:
+                self.log("add", addr)
+            return new
+
+    def forget(self, addr):
+        self.loads.pop(addr, None)
+        self.handed.pop(addr, None)
+        self.log("remove", addr)
+
+    def remove(self, addr):
+        with self.cond:
+            if self.peers.pop(addr, None) is None:
+                return False
+            self.forget(addr)
+            return True
+
+    def expire(self):
+        # Drop peers whose last heartbeat is older than the TTL
+        expired = []
+        with self.cond:
+            deadline = time.monotonic() - self.ttl
+            while self.peers:
+                addr, last_seen = next(iter(self.peers.items()))
+                if last_seen >= deadline:
+                    break
+                self.peers.popitem(last = False)
+                self.forget(addr)
+                expired.append(addr)
+        return expired
+
+    def select(self, count = 0, order = "load", offset = 0):
+        # Live peers ranked by their last load report, the first count of them if count is set.
+        # Peers handed out since their report count one more range each, so clients asking
+        # between heartbeats spread out instead of all picking the same peers.
+        # Pages are sorted by address instead, so they stay stable while a client walks them.
+        self.expire()
+        with self.cond:
+            if order == "page":
+                peers = sorted(self.peers)[offset:]
+                return peers[:count] if count else peers
+
+            if order == "sample":
+                return random.sample(list(self.peers), min(count or len(self.peers), len(self.peers)))
+
+            def rank(addr):
+                inflight, capacity, throughput = self.loads.get(addr, (0, 1, 0))
+                inflight += self.handed.get(addr, 0)
+                if order == "capacity":
+                    return (inflight - capacity, -throughput)
+                return (inflight / max(capacity, 1), -throughput)
+
+            # Shuffled first so ties are broken differently for every client
+            peers = list(self.peers)
+            random.shuffle(peers)
+            peers.sort(key = rank)
+
+            if count:
+                peers = peers[:count]
+                for addr in peers:
+                    self.handed[addr] = self.handed.get(addr, 0) + 1
+
+            return peers
+
+    def snapshot(self):
+        with self.cond:
+            return (self.version, list(self.peers))
+
+    def changes(self, since, timeout = 0):
+        # Wait up to timeout for changes after version since. Returns (version, events),
+        # events is None when since is unknown or too old to replay from the log.
+        with self.cond:
+            self.cond.wait_for(lambda: self.version != since, timeout)
+
+            if since == self.version:
+                return (self.version, [])
+
+            if since > self.version or not self.events or self.events[0][0] > since + 1:
+                return (self.version, None)
+
+            return (self.version, [event for event in self.events if event[0] > since])
+
+    def __len__(self):
+        with self.cond:
+            return len(self.peers)
@@ -0,0 +1,113 @@
+import time
+import logging
+from utils.packet_utils import ClientProtocol, FRAME_DATA, FRAME_END, FRAME_ERROR
+
+class PeerSession:
+    # Ranges in flight on one connection to a peer server and what each frame does to them.
+    # Both download engines read frames their own way and hand them here, blocking calls
+    # (writing data, settling chunks) included, so the async engine runs handle_frame in a thread.
+    def __init__(self, client, peer, scheduler):
+        self.client = client
+        self.peer = peer
+        self.scheduler = scheduler
+        self.client_proto = ClientProtocol()
+
+        # request ID -> [chunk, range, bytes received, still valid, mirror URL, time sent]
+        self.inflight = {}
+        self.completed = 0
+        self.next_id = 0
+        self.start = time.monotonic()
+
+    def add(self, chunk):
+        # Requests on this connection get their own IDs, chunks of different files share it
+        key, download_range = chunk
+        self.next_id += 1
+        self.inflight[self.next_id] = [key, download_range, 0, True, key[0].mirrors.acquire(), None]
+        return self.next_id
+
+    def request(self, request_id):
+        # Returns the range request to send for a chunk added with add()
+        key, download_range, received, valid, url, sent_at = self.inflight[request_id]
+        now = time.monotonic()
+        if len(self.inflight) == 1:
+            # Idle time does not count against the peer's throughput
+            self.start = now
+
+        logging.info(f"Downloading for range {download_range} from {self.peer} via {url}")
+        self.inflight[request_id][5] = now
+        self.client.trace_chunk("request", key, peer = self.peer, request = request_id, url = url)
+        return self.client_proto.gen_range_request(request_id, url, download_range, key[0].cache_validator)
+
+    def check_header(self, header):
+        # Checked before the payload is read, a bad frame fails the connection with every range still in flight
+        if not header or header[2] not in self.inflight:
+            raise ConnectionError("Data not received!")
+
+        if header[0] not in (FRAME_DATA, FRAME_END, FRAME_ERROR):
+            raise ConnectionError(f"Unexpected frame of type {header[0]}!")
+
+        return header
+
+    def handle_frame(self, header, payload):
+        # payload is the decoded data (None if corrupt) of a data frame or the message of an error frame.
+        # Returns True if the frame took its range off the connection.
+        client = self.client
+        type, flags, request_id, offset, length, payload_len = header
+        key, download_range, received, valid, url, sent_at = self.inflight[request_id]
+
+        if type == FRAME_DATA:
+            if not valid:
+                # Range already handed back to the scheduler, drain the rest
+                return False
+
+            if offset != download_range[0] + received:
+                raise ConnectionError(f"Peer sent data at {offset}, expected {download_range[0] + received}!")
+
+            if payload is None:
+                logging.error(f"Checksum mismatch from {self.peer} at {offset}!")
+                self.inflight[request_id][3] = False
+                client.fail_range(self.scheduler, self.peer, key, (offset, download_range[1]), request_id)
+                return False
+
+            # Chunks already finished by a hedge are drained without writing
+            if not self.scheduler.is_done(key):
+                key[0].land(offset, payload)
+            self.inflight[request_id][2] += len(payload)
+            return False
+
+        # Checked while the range is still in flight, so the failed connection hands it back
+        if type == FRAME_END and valid and length != received:
+            raise ConnectionError(f"Peer sent {received} bytes, expected {length}!")
+
+        del self.inflight[request_id]
+
+        if type == FRAME_ERROR:
+            # The peer could not fetch the range from this mirror
+            key[0].mirrors.release(url, failed = valid)
+            if valid:
+                logging.error(f"Peer error: {bytes(payload).decode(errors = 'replace')}")
+                client.fail_range(self.scheduler, self.peer, key, (download_range[0] + received, download_range[1]), request_id)
+            return True
+
+        elapsed = time.monotonic() - sent_at
+        key[0].mirrors.release(url, received if valid else 0, elapsed)
+
+        if valid and client.finish_range(self.scheduler, self.peer, key, download_range, received, elapsed, request_id):
+            self.completed += 1
+
+            # Requests are served in order, so each one took the time since the previous finished
+            now = time.monotonic()
+            client.peer_stats.record(self.peer, received, now - self.start)
+            self.start = now
+
+        return True
+
+    def hand_back(self):
+        # Reassign whatever the peer had not delivered yet, once the connection failed
+        for request_id, (key, download_range, received, valid, url, sent_at) in self.inflight.items():
+            if valid:
+                self.client.finish_range(self.scheduler, self.peer, key, download_range, received, request_id = request_id)
+
+    def close(self):
+        for key, download_range, received, valid, url, sent_at in self.inflight.values():
+            key[0].mirrors.release(url)
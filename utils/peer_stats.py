@@ -0,0 +1,47 @@
+import os
+import json
+import threading
+
+class PeerStats:
+    # EWMA of per-peer throughput in bytes/s, persisted as JSON between jobs
+    def __init__(self, path, alpha = 0.3):
+        self.path = str(path)
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.throughputs = {}
+
+        try:
+            with open(self.path, "r") as f:
+                self.throughputs = {k: float(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def record(self, peer, size, seconds):
+        if size <= 0 or seconds <= 0:
+            return
+
+        sample = size / seconds
+        with self.lock:
+            old = self.throughputs.get(peer)
+            self.throughputs[peer] = sample if old is None else self.alpha * sample + (1 - self.alpha) * old
+
+    def stats(self):
+        with self.lock:
+            return dict(self.throughputs)
+
+    def weights(self, peers):
+        # Expected bandwidth per peer, unknown peers are assumed to be average
+        with self.lock:
+            known = [self.throughputs[p] for p in peers if p in self.throughputs]
+            default = sum(known) / len(known) if known else 1.0
+            return [self.throughputs.get(p, default) for p in peers]
+
+    def save(self):
+        with self.lock:
+            data = dict(self.throughputs)
+
+        # Write atomically so a crash never leaves a truncated store
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
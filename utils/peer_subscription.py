@@ -0,0 +1,125 @@
+import time
+import socket
+import logging
+import threading
+from utils.packet_utils import ClientProtocol, PEER_EVENT, EVENT_RESET, EVENT_ADD, EVENT_REMOVE, EVENT_SYNC
+from utils.socket_utils import recv_exact
+
+class PeerSubscription:
+    # Peer list kept current by one long-lived subscription to the tracker. The tracker sends
+    # a keepalive well within max_age, so a quieter connection is dropped and resynced rather
+    # than trusted. Peers are (IP, port), port 0 if the peer never reported one. on_add(peer) and
+    # on_remove(peer) are called outside the lock for every change.
+    def __init__(self, tracker_ip, tracker_port, max_age = 30, on_add = None, on_remove = None):
+        self.tracker_ip = tracker_ip
+        self.tracker_port = int(tracker_port)
+        self.max_age = float(max_age)
+        self.on_add = on_add
+        self.on_remove = on_remove
+        self.client_proto = ClientProtocol()
+        self.peers = set()
+        self.snapshot = None
+        self.version = 0
+        self.synced = False
+        self.updated = 0
+        self.cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target = self.run, daemon = True).start()
+
+    def run(self):
+        # Reconnect for as long as the process lives, backing off while the tracker is down
+        failures = 0
+        while True:
+            try:
+                self.session()
+            except OSError as e:
+                logging.error(f"Tracker subscription failed: {e}")
+
+            with self.cond:
+                self.synced = False
+                failures = 0 if self.updated and time.monotonic() - self.updated < self.max_age else failures + 1
+
+            time.sleep(min(2 ** failures, 10))
+
+    def session(self):
+        sock = socket.create_connection((self.tracker_ip, self.tracker_port), timeout = self.max_age)
+
+        try:
+            sock.sendall(self.client_proto.gen_handshake().encode())
+            if not self.client_proto.validate_handshake(recv_exact(sock, 2)):
+                raise ConnectionError("Invalid handshake!")
+
+            # Resume from the last version seen, the tracker replays what we missed or sends a snapshot
+            sock.sendall(self.client_proto.gen_subscribe(self.version))
+            logging.info(f"Subscribed to tracker at {self.tracker_ip}:{self.tracker_port}")
+
+            while True:
+                data = recv_exact(sock, PEER_EVENT.size)
+                if not data:
+                    raise ConnectionError("Tracker closed the subscription!")
+
+                out = self.client_proto.parse_peer_event(data)
+                if not out:
+                    raise ConnectionError("Invalid peer event!")
+
+                type, version, port, ip_len = out
+                self.apply(type, version, (recv_exact(sock, ip_len).decode(), port))
+
+        finally:
+            sock.close()
+
+    def apply(self, type, version, peer):
+        added = []
+        removed = []
+
+        with self.cond:
+            if type == EVENT_RESET:
+                # Changes are worked out against the old list once the snapshot is complete
+                self.snapshot = set()
+
+            elif type == EVENT_ADD and self.snapshot is not None:
+                self.snapshot.add(peer)
+
+            elif type == EVENT_ADD and peer not in self.peers:
+                self.peers.add(peer)
+                added.append(peer)
+
+            elif type == EVENT_REMOVE and peer in self.peers:
+                self.peers.discard(peer)
+                removed.append(peer)
+
+            elif type == EVENT_SYNC:
+                if self.snapshot is not None:
+                    added = list(self.snapshot - self.peers)
+                    removed = list(self.peers - self.snapshot)
+                    self.peers = self.snapshot
+                    self.snapshot = None
+                self.synced = True
+
+            self.version = version
+            self.updated = time.monotonic()
+            self.cond.notify_all()
+
+        for peer in added:
+            logging.info(f"Peer server {peer} joined")
+            if self.on_add:
+                self.on_add(peer)
+
+        for peer in removed:
+            logging.info(f"Peer server {peer} left")
+            if self.on_remove:
+                self.on_remove(peer)
+
+    def wait_synced(self, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.synced, timeout)
+
+    def live_peers(self):
+        with self.cond:
+            return sorted(self.peers)
+
+    def age(self):
+        # Seconds since the tracker was last heard from
+        with self.cond:
+            return time.monotonic() - self.updated if self.updated else None
@@ -0,0 +1,220 @@
+import time
+import threading
+from collections import deque
+
+def split_range(start, end, chunk_size):
+    # Split inclusive byte range into chunks of at most chunk_size bytes
+    return [(i, min(i + chunk_size, end + 1) - 1) for i in range(start, end + 1, chunk_size)]
+
+class ChunkScheduler:
+    # Shared queue of chunks, every worker pulls the next one as soon as it finishes one.
+    # Chunks may be assigned to a worker up front; once a worker runs dry it steals
+    # unstarted chunks from whoever has the most left. Failed chunks go back on the
+    # queue, and idle workers hedge the oldest straggler once nothing else is left.
+    def __init__(self, chunks, owners = None, max_retries = 3, hedge_delay = 5.0, keep_open = False):
+        self.pending = deque()
+        self.assigned = {}
+        self.inflight = {}
+        self.retries = {}
+
+        # Hedges still running on chunks another worker completed, and those of them whose job
+        # is closed, which are only forgotten once the losing hedge settles
+        self.losing = {}
+        self.lingering = set()
+        self.done = set()
+        self.failed = set()
+        self.max_retries = int(max_retries)
+        self.hedge_delay = float(hedge_delay)
+        self.cond = threading.Condition()
+        self.watchers = []
+        self.takers = []
+
+        # When each pending chunk was queued, to tell how long it waited for a worker
+        self.queued_at = {}
+
+        # An open scheduler keeps its workers waiting for chunks added later, until closed
+        self.open = keep_open
+        self.queue(chunks, owners)
+
+    def queue(self, chunks, owners):
+        now = time.monotonic()
+        for i, chunk in enumerate(chunks):
+            self.queued_at[chunk[0]] = now
+            if owners is None or owners[i] is None:
+                self.pending.append(chunk)
+            else:
+                self.assigned.setdefault(owners[i], deque()).append(chunk)
+
+    def watch(self, callback):
+        # Call callback, under the scheduler lock, whenever chunks are added, settled or handed back
+        with self.cond:
+            self.watchers.append(callback)
+
+    def watch_takes(self, callback):
+        # Call callback(chunk, worker, waited), under the scheduler lock, whenever a chunk is handed to a worker.
+        # waited is how long the chunk was queued, or None for a hedge.
+        with self.cond:
+            self.takers.append(callback)
+
+    def notify(self):
+        self.cond.notify_all()
+        for callback in self.watchers:
+            callback()
+
+    def add(self, chunks, owners = None):
+        with self.cond:
+            self.queue(chunks, owners)
+            self.notify()
+
+    def close(self):
+        with self.cond:
+            self.open = False
+            self.notify()
+
+    def next_chunk(self, worker = None, steal = True, wait = False, cancel = None):
+        # Returns (index, range), or None once there is nothing left for this worker or cancel is set
+        with self.cond:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    return None
+
+                chunk = self.poll(worker, steal, wait)
+                if chunk is not False:
+                    return chunk
+
+                # In-flight chunks may still fail and come back
+                self.cond.wait(0.5)
+
+    def poll(self, worker = None, steal = True, wait = False):
+        # Non-blocking next_chunk, returns False instead of waiting when a chunk may still turn up
+        with self.cond:
+            chunk = self.take(worker, steal)
+            if chunk is not None:
+                now = time.monotonic()
+                self.inflight[chunk[0]] = [chunk[1], now, {worker}]
+                self.taken(chunk, worker, now - self.queued_at.pop(chunk[0], now))
+                return chunk
+
+            if not wait or not (self.inflight or self.open):
+                return None
+
+            chunk = self.hedge(worker)
+            if chunk is None:
+                return False
+
+            self.taken(chunk, worker, None)
+            return chunk
+
+    def taken(self, chunk, worker, waited):
+        for callback in self.takers:
+            callback(chunk, worker, waited)
+
+    def take(self, worker, steal):
+        own = self.assigned.get(worker)
+        if own:
+            return own.popleft()
+
+        if self.pending:
+            return self.pending.popleft()
+
+        victim = max(self.assigned.values(), key = len, default = None)
+        if victim and steal:
+            return victim.pop()
+
+        return None
+
+    def hedge(self, worker):
+        # Duplicate the oldest in-flight chunk that has been running for too long
+        now = time.monotonic()
+        for i, (chunk_range, started, workers) in self.inflight.items():
+            if len(workers) == 1 and worker not in workers and now - started >= self.hedge_delay:
+                workers.add(worker)
+                return (i, chunk_range)
+
+        return None
+
+    def complete(self, i, worker = None):
+        # Returns True for the first completion of a chunk, hedges that finish later get False
+        with self.cond:
+            if i in self.done:
+                self.settle_loser(i, worker)
+                return False
+
+            self.done.add(i)
+            entry = self.inflight.pop(i, None)
+            if entry:
+                entry[2].discard(worker)
+                if entry[2]:
+                    self.losing[i] = entry[2]
+            self.notify()
+            return True
+
+    def fail(self, i, remaining, worker = None):
+        # Requeue the unfinished part of a chunk, unless a hedge is still running it.
+        # Returns True if the chunk ran out of retries and was given up on.
+        with self.cond:
+            if i in self.done:
+                self.settle_loser(i, worker)
+                return False
+
+            entry = self.inflight.get(i)
+            if entry:
+                entry[2].discard(worker)
+                if entry[2]:
+                    return False
+                del self.inflight[i]
+
+            self.retries[i] = self.retries.get(i, 0) + 1
+            self.notify()
+
+            if self.retries[i] > self.max_retries:
+                self.failed.add(i)
+                return True
+
+            self.pending.appendleft((i, remaining))
+            self.queued_at[i] = time.monotonic()
+            return False
+
+    def settle_loser(self, i, worker):
+        # A hedge that lost the race is over, forget the chunk now if its job is already closed
+        workers = self.losing.get(i)
+        if workers is None:
+            return
+
+        workers.discard(worker)
+        if workers:
+            return
+
+        del self.losing[i]
+        if i in self.lingering:
+            self.lingering.discard(i)
+            self.drop(i)
+
+    def forget(self, chunks):
+        # Drop bookkeeping of settled chunks, so a long-running scheduler does not grow without bound.
+        # Chunks a losing hedge is still running stay done until it settles, so it is not counted or requeued.
+        with self.cond:
+            for i in chunks:
+                if i in self.losing:
+                    self.lingering.add(i)
+                else:
+                    self.drop(i)
+
+    def drop(self, i):
+        self.done.discard(i)
+        self.failed.discard(i)
+        self.retries.pop(i, None)
+        self.queued_at.pop(i, None)
+
+    def finished(self):
+        # Nothing left to hand out or waiting on a worker, and no more chunks coming
+        return not self.open and not self.pending and not self.inflight and not any(self.assigned.values())
+
+    def wait_finished(self, timeout):
+        # Sleep up to timeout seconds, waking early once the job is finished
+        with self.cond:
+            return self.cond.wait_for(self.finished, timeout)
+
+    def is_done(self, i):
+        with self.cond:
+            return i in self.done
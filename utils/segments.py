@@ -0,0 +1,108 @@
+import queue
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+import requests
+from utils.scheduler import split_range
+
+# Most segments of one range fetched at once when auto-tuning
+MAX_SEGMENTS = 8
+
+# Fraction of the best throughput a smaller segment count may lose and still be preferred
+TUNE_MARGIN = 0.1
+
+class Segment:
+    # One sub-range fetch, its blocks are queued until the reader gets to them
+    def __init__(self, segment_range):
+        self.range = segment_range
+        self.blocks = queue.Queue()
+
+    def run(self, fetch, cancel, first):
+        try:
+            for block in fetch(self.range, cancel):
+                if cancel.is_set():
+                    break
+                self.blocks.put(block)
+
+        except requests.HTTPError as e:
+            # Segments past the end of the file are simply empty
+            if first or e.response is None or e.response.status_code != 416:
+                self.blocks.put(e)
+
+        except Exception as e:
+            self.blocks.put(e)
+
+        self.blocks.put(None)
+
+    def __iter__(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+
+def fetch_segments(fetch, pool, ranges, count, segment_size):
+    # Fetch ranges as segment_size sub-ranges, count of them at once, and yield their blocks in order.
+    # At most count segments are fetched or buffered ahead of the reader, which bounds the memory used.
+    # fetch(range, cancel) yields the blocks of one sub-range and should stop once cancel is set.
+    segments = deque(split_range(ranges[0], ranges[1], segment_size))
+    window = deque()
+    cancel = threading.Event()
+
+    try:
+        while segments or window:
+            while segments and len(window) < count:
+                segment = Segment(segments.popleft())
+                pool.submit(segment.run, fetch, cancel, segment.range[0] == ranges[0])
+                window.append(segment)
+
+            segment = window.popleft()
+            size = 0
+            for block in segment:
+                size += len(block)
+                yield block
+
+            if size < segment.range[1] - segment.range[0] + 1:
+                # File ended inside this segment, the ones after it are empty
+                return
+
+    finally:
+        cancel.set()
+
+class SegmentTuner:
+    # Picks the number of segments per origin host from the throughput each count achieved.
+    # The smallest count within TUNE_MARGIN of the best is used, and while that is the largest
+    # count tried so far, one more segment is tried in case the origin limits each connection.
+    def __init__(self, max_segments = MAX_SEGMENTS, alpha = 0.3):
+        self.max_segments = int(max_segments)
+        self.alpha = alpha
+        self.rates = {}
+        self.lock = threading.Lock()
+
+    def count(self, url):
+        with self.lock:
+            rates = self.rates.get(urlsplit(url).netloc)
+            if not rates:
+                return 1
+
+            best = max(rates.values())
+            count = min(n for n, rate in rates.items() if rate >= (1 - TUNE_MARGIN) * best)
+            if count == max(rates) and count < self.max_segments:
+                return count + 1
+            return count
+
+    def record(self, url, count, size, seconds):
+        if size <= 0 or seconds <= 0:
+            return
+
+        sample = size / seconds
+        with self.lock:
+            rates = self.rates.setdefault(urlsplit(url).netloc, {})
+            old = rates.get(count)
+            rates[count] = sample if old is None else self.alpha * sample + (1 - self.alpha) * old
+
+    def stats(self):
+        with self.lock:
+            return {host: {n: int(rate) for n, rate in sorted(rates.items())} for host, rates in self.rates.items()}
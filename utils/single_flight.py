@@ -0,0 +1,76 @@
+import threading
+
+class Flight:
+    # One upstream fetch of size bytes from start. The buffer is allocated up front and filled
+    # in place, so readers can hold views into it while the fetch is still running.
+    def __init__(self, start, size):
+        self.start = start
+        self.buf = bytearray(size)
+        self.filled = 0
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def write(self, data):
+        with self.cond:
+            size = min(len(data), len(self.buf) - self.filled)
+            self.buf[self.filled:(self.filled + size)] = data[:size]
+            self.filled += size
+            self.cond.notify_all()
+
+    def finish(self, error = None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def wait(self, pos):
+        # Block until the first pos bytes are in, or the fetch ended short of them.
+        # Returns the number of bytes available, raises the fetch's error if it failed first.
+        with self.cond:
+            self.cond.wait_for(lambda: self.filled >= pos or self.done)
+            if self.filled < pos and self.error:
+                raise self.error
+            return self.filled
+
+    def view(self, start, end):
+        return memoryview(self.buf)[start:end]
+
+class SingleFlight:
+    # Table of in-flight fetches by file, so concurrent requests for overlapping spans share one fetch
+    def __init__(self):
+        self.flights = {}
+        self.fetches = 0
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def join(self, file, start, size):
+        # Returns (flight, leader), the leader has to run the fetch of size bytes from start.
+        # A fetch of the same file already in flight whose span holds start is joined instead.
+        with self.lock:
+            for flight in self.flights.get(file, ()):
+                if flight.start <= start < flight.start + len(flight.buf):
+                    self.coalesced += 1
+                    return (flight, False)
+
+            flight = Flight(start, size)
+            self.flights.setdefault(file, []).append(flight)
+            self.fetches += 1
+            return (flight, True)
+
+    def land(self, file, flight):
+        # The fetch is over, later requests start a new one (or hit the cache)
+        with self.lock:
+            flights = self.flights.get(file, [])
+            if flight in flights:
+                flights.remove(flight)
+            if not flights:
+                self.flights.pop(file, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'fetches': self.fetches,
+                'coalesced': self.coalesced,
+                'in_flight': sum(len(flights) for flights in self.flights.values())
+            }
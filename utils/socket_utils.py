@@ -0,0 +1,35 @@
+import socket
+import select
+
+def recv_exact(sock, size):
+    # Receive exactly size bytes, or fewer if the peer closed the connection
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            break
+        received += n
+    return bytes(data[:received])
+
+def recv_into_exact(sock, view):
+    # Fill view from the socket, returns the number of bytes received before the peer closed
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:])
+        if not n:
+            break
+        received += n
+    return received
+
+def is_dropped(sock):
+    # True if the other side closed an idle connection, checked without blocking
+    readable, _, _ = select.select([sock], [], [], 0)
+    if not readable:
+        return False
+
+    try:
+        return not sock.recv(1, socket.MSG_PEEK)
+    except OSError:
+        return True